@@ -0,0 +1,315 @@
+# benchmarks/fakes.py
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from benchmarks.synthetic import make_raw, metadata
+
+
+class FaultConfig:
+    """Latency and failure injection for the fake services.
+
+    latency: seconds per HTTP round trip (a batch request counts as one)
+    per_item_latency: extra seconds per sub-request inside a batch
+    error_rate: probability that a call fails with 503
+    throttle_rate: probability that a call fails with 429
+    """
+
+    def __init__(self, latency: float = 0.05, per_item_latency: float = 0.0005,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def roll(self) -> Optional[int]:
+        """Status code of an injected failure, or None."""
+        with self._lock:
+            r = self._rng.random()
+        if r < self.throttle_rate:
+            return 429
+        if r < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+
+def _http_error(status: int, reason: str) -> HttpError:
+    content = json.dumps({"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}}).encode()
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+class FakeRequest:
+    def __init__(self, service: "FakeGmailService", endpoint: str, fn):
+        self.service = service
+        self.endpoint = endpoint
+        self._fn = fn
+
+    def _run(self):
+        self.service.calls[self.endpoint] = self.service.calls.get(self.endpoint, 0) + 1
+        status = self.service.faults.roll()
+        if status is not None:
+            raise _http_error(status, "rateLimitExceeded" if status == 429 else "backendError")
+        return self._fn()
+
+    def execute(self, http=None, num_retries=0):
+        time.sleep(self.service.faults.latency)
+        return self._run()
+
+
+class FakeBatch:
+    def __init__(self, service: "FakeGmailService", callback):
+        self.service = service
+        self.callback = callback
+        self._requests: List[tuple] = []
+
+    def add(self, request: FakeRequest, callback=None, request_id=None):
+        self._requests.append((request, callback or self.callback, request_id or str(len(self._requests))))
+
+    def execute(self, http=None):
+        time.sleep(self.service.faults.latency + self.service.faults.per_item_latency * len(self._requests))
+        for request, callback, request_id in self._requests:
+            try:
+                callback(request_id, request._run(), None)
+            except HttpError as e:
+                callback(request_id, None, e)
+
+
+class _Messages:
+    def __init__(self, service: "FakeGmailService"):
+        self.s = service
+
+    def list(self, userId="me", q="", maxResults=100, pageToken=None, fields=None, **_):
+        def run():
+            ids = self.s.visible_ids(q)
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            resp: Dict[str, Any] = {"resultSizeEstimate": len(ids)}
+            if page:
+                resp["messages"] = [{"id": mid, "threadId": mid} for mid in page]
+            if start + maxResults < len(ids):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+        return FakeRequest(self.s, "messages.list", run)
+
+    def get(self, userId="me", id=None, format="full", metadataHeaders=None, fields=None, **_):
+        def run():
+            msg = self.s.messages.get(id)
+            if msg is None:
+                raise _http_error(404, "notFound")
+            if format == "raw":
+                return {"id": id, "raw": make_raw(msg)}
+            out = metadata(msg)
+            if metadataHeaders:
+                wanted = {h.lower() for h in metadataHeaders}
+                out["payload"] = {"headers": [h for h in out["payload"]["headers"] if h["name"].lower() in wanted]}
+            return out
+        return FakeRequest(self.s, "messages.get", run)
+
+    def batchModify(self, userId="me", body=None, **_):
+        def run():
+            for mid in body.get("ids", []):
+                self.s.relabel(mid, body.get("addLabelIds", []), body.get("removeLabelIds", []))
+            return ""
+        return FakeRequest(self.s, "messages.batchModify", run)
+
+    def modify(self, userId="me", id=None, body=None, **_):
+        def run():
+            self.s.relabel(id, body.get("addLabelIds", []), body.get("removeLabelIds", []))
+            return metadata(self.s.messages[id])
+        return FakeRequest(self.s, "messages.modify", run)
+
+    def trash(self, userId="me", id=None, **_):
+        def run():
+            self.s.relabel(id, ["TRASH"], ["INBOX"])
+            return {"id": id}
+        return FakeRequest(self.s, "messages.trash", run)
+
+    def batchDelete(self, userId="me", body=None, **_):
+        def run():
+            for mid in body.get("ids", []):
+                self.s.delete(mid)
+            return ""
+        return FakeRequest(self.s, "messages.batchDelete", run)
+
+
+class _History:
+    def __init__(self, service: "FakeGmailService"):
+        self.s = service
+
+    def list(self, userId="me", startHistoryId=None, pageToken=None, maxResults=100, fields=None, **_):
+        def run():
+            start = int(startHistoryId)
+            records = [r for r in self.s.history if int(r["id"]) > start]
+            offset = int(pageToken or 0)
+            resp = {"history": records[offset:offset + maxResults], "historyId": str(self.s.history_id)}
+            if offset + maxResults < len(records):
+                resp["nextPageToken"] = str(offset + maxResults)
+            return resp
+        return FakeRequest(self.s, "history.list", run)
+
+
+class _Users:
+    def __init__(self, service: "FakeGmailService"):
+        self.s = service
+
+    def messages(self):
+        return _Messages(self.s)
+
+    def history(self):
+        return _History(self.s)
+
+    def getProfile(self, userId="me", fields=None, **_):
+        return FakeRequest(self.s, "users.getProfile", lambda: {"historyId": str(self.s.history_id)})
+
+
+class FakeGmailService:
+    """
+    In-memory stand-in for the googleapiclient Gmail resource used by GmailClient.
+    Supports messages.list/get/modify/batchModify/trash/batchDelete, history.list,
+    getProfile and HTTP batches, with latency and error injection from FaultConfig.
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]], faults: Optional[FaultConfig] = None):
+        self.faults = faults or FaultConfig()
+        self.messages = {m["id"]: m for m in messages}
+        self.order = [m["id"] for m in messages]
+        self.calls: Dict[str, int] = {}
+        self.history: List[Dict[str, Any]] = []
+        self.history_id = 1000
+        self._lock = threading.Lock()
+        self._visible: Dict[str, List[str]] = {}
+
+    def visible_ids(self, q: str = "") -> List[str]:
+        cached = self._visible.get(q)
+        if cached is not None:
+            return cached
+        # after:/before: with epoch seconds, as used by date-partitioned listing;
+        # messages are kept newest first, so a date range is a slice of the undated result
+        after = [int(v) for v in re.findall(r"after:(\d+)", q)]
+        before = [int(v) for v in re.findall(r"before:(\d+)", q)]
+        if after or before:
+            undated = re.sub(r"(after|before):\d+", " ", q).strip()
+            base = self.visible_ids(undated)
+            neg = self._visible.get("\0dates:" + undated)
+            if neg is None:
+                neg = self._visible["\0dates:" + undated] = [-(int(self.messages[mid]["internalDate"]) // 1000) for mid in base]
+            lo = bisect.bisect_right(neg, -min(before)) if before else 0
+            hi = bisect.bisect_left(neg, -max(after)) if after else len(base)
+            out = base[lo:hi]
+            self._visible[q] = out
+            return out
+        words = [w.lower() for w in re.findall(r"\w+", q)]
+        out = []
+        for mid in self.order:
+            msg = self.messages.get(mid)
+            if msg is None or "TRASH" in msg["labelIds"]:
+                continue
+            if words:
+                subject = next((h["value"] for h in msg["payload"]["headers"] if h["name"] == "Subject"), "").lower()
+                if not all(w in subject for w in words):
+                    continue
+            out.append(mid)
+        self._visible[q] = out
+        return out
+
+    def _record(self, kind: str, item: Dict[str, Any]):
+        self._visible.clear()
+        self.history_id += 1
+        self.history.append({"id": str(self.history_id), kind: [item]})
+
+    def relabel(self, mid: str, add: List[str], remove: List[str]):
+        with self._lock:
+            msg = self.messages.get(mid)
+            if msg is None:
+                raise _http_error(404, "notFound")
+            msg["labelIds"] = [l for l in msg["labelIds"] if l not in remove] + [l for l in add if l not in msg["labelIds"]]
+            if add:
+                self._record("labelsAdded", {"message": {"id": mid}, "labelIds": list(add)})
+            if remove:
+                self._record("labelsRemoved", {"message": {"id": mid}, "labelIds": list(remove)})
+
+    def delete(self, mid: str):
+        with self._lock:
+            if self.messages.pop(mid, None) is not None:
+                self._record("messagesDeleted", {"message": {"id": mid}})
+
+    def deliver(self, message: Dict[str, Any]):
+        """Simulate new mail arriving (shows up in history.list)."""
+        with self._lock:
+            self.messages[message["id"]] = message
+            self.order.insert(0, message["id"])
+            self._record("messagesAdded", {"message": {"id": message["id"]}})
+
+    def users(self):
+        return _Users(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+class FakeRateLimitError(Exception):
+    """Shaped like anthropic.RateLimitError for the parts the app looks at."""
+    status_code = 429
+
+
+class FakeClaudeClient:
+    """Stand-in for anthropic.Client: messages.create returns canned JSON after a delay."""
+
+    def __init__(self, latency: float = 0.8, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.input_chars = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, model=None, max_tokens=None, messages=None, **_):
+        prompt = messages[-1]["content"] if messages else ""
+        with self._lock:
+            self.requests += 1
+            self.input_chars += len(prompt)
+            throttled = self._rng.random() < self.throttle_rate
+        time.sleep(self.latency)
+        if throttled:
+            raise FakeRateLimitError("rate_limit_error")
+        n_items = len(re.findall(r"^\[(\d+)\]$", prompt, re.M))
+        if n_items:
+            text = json.dumps([{"id": i, "score": 0.7, "reason": "Synthetic score."} for i in range(1, n_items + 1)])
+        else:
+            text = json.dumps({"label": "Synthetic group", "summary": "Messages grouped by the benchmark."})
+        usage = SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4)
+        return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=usage)
+
+
+class HashEncoder:
+    """
+    Cheap deterministic stand-in for SentenceTransformer: hashed bag of words
+    projected to `dim` dimensions. Lets clustering be timed without the model.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, convert_to_numpy=True, show_progress_bar=False, **_):
+        import numpy as np
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"[a-z]+", text.lower()):
+                h = zlib.crc32(word.encode("utf-8"))
+                out[row, h % self.dim] += 1.0 if (h >> 20) & 1 else -1.0
+        return out
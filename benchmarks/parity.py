@@ -0,0 +1,43 @@
+# benchmarks/parity.py
+"""
+Time the torch and int8 ONNX embedding backends on the same synthetic texts:
+
+    python -m benchmarks.parity --n 2000
+
+Reports model load time and per-message encode time for each backend. Whether
+the two agree (cosine similarity, nearest neighbours, clusters) is checked by
+tests/test_parity.py.
+"""
+import argparse
+import sys
+import time
+
+from benchmarks.synthetic import make_mailbox, meta_texts
+
+
+def _time(backend: str, texts):
+    from clustering import Clusterer
+    clusterer = Clusterer(cache_dir=None, backend=backend)
+    start = time.perf_counter()
+    clusterer.model
+    load = time.perf_counter() - start
+    start = time.perf_counter()
+    clusterer.embed_texts(texts)
+    encode = time.perf_counter() - start
+    print(f"{backend:<6} load {load:6.2f}s  encode {1000 * encode / len(texts):6.3f} ms/message")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the ONNX int8 and torch embedding backends.")
+    parser.add_argument("--n", type=int, default=2000, help="number of synthetic messages")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    texts = meta_texts(make_mailbox(args.n, seed=args.seed))
+    for backend in ("torch", "onnx"):
+        _time(backend, texts)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
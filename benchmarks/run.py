@@ -0,0 +1,179 @@
+# benchmarks/run.py
+"""
+Offline benchmark of the mail pipeline against a synthetic mailbox.
+
+    python -m benchmarks.run --sizes 1000 10000 --out bench.json
+    python -m benchmarks.run --sizes 1000 --compare bench.json
+
+Gmail and Claude are replaced by the fakes in benchmarks/fakes.py, so no
+account or API key is needed. Embeddings use the real model unless
+--fake-embed is given (or sentence-transformers is not installed).
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from benchmarks.fakes import FakeClaudeClient, FakeGmailService, FaultConfig, HashEncoder
+from benchmarks.synthetic import make_mailbox, make_raw, meta_texts
+
+
+def _revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def _time(stage: str, size: int, items: int, fn: Callable[[], Any], results: List[Dict[str, Any]]) -> Any:
+    start = time.perf_counter()
+    out = fn()
+    seconds = time.perf_counter() - start
+    results.append({
+        "size": size,
+        "stage": stage,
+        "items": items,
+        "seconds": round(seconds, 4),
+        "items_per_sec": round(items / seconds, 1) if seconds > 0 else None,
+    })
+    print(f"  {stage:<20} {items:>8} items  {seconds:8.3f}s")
+    return out
+
+
+def _make_clusterer(fake_embed: bool, cache_dir: str, backend: str = "torch"):
+    from clustering import Clusterer
+    if not fake_embed:
+        try:
+            clusterer = Clusterer(cache_dir=cache_dir, backend=backend)
+            clusterer.model  # loaded lazily; load now so the failure is handled here
+            return clusterer, backend
+        except ImportError:
+            print("sentence-transformers not available, falling back to --fake-embed")
+    return Clusterer(model_name="hash-encoder", cache_dir=cache_dir, model=HashEncoder()), "fake"
+
+
+def run_size(n: int, args, results: List[Dict[str, Any]]) -> str:
+    import claude_client
+    from gmail_client import GmailClient
+    from clustering import LABEL_CANDIDATES
+    from utils import RateLimiter, evenly_spaced, prefetch
+    from processor import extract_plaintext_from_raw, extract_plaintext_batch
+
+    print(f"mailbox of {n} messages")
+    messages = make_mailbox(n, seed=args.seed)
+    faults = FaultConfig(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed)
+    service = FakeGmailService(messages, faults)
+    # the fake has no quota of its own; --gmail-quota 250 reproduces the real per-user ceiling
+    gmail = GmailClient(service=service, limiter=RateLimiter(args.gmail_quota or 1e9, name="gmail"))
+
+    ids = _time("list", n, n, lambda: gmail.list_message_ids("", max_results=n), results)
+    metas = _time("metadata", n, len(ids), lambda: gmail.get_messages_meta(ids), results)
+
+    sample = messages[:min(n, args.extract_sample)]
+    raws = [make_raw(m) for m in sample]
+    _time("extract_serial", n, len(raws), lambda: [extract_plaintext_from_raw(r) for r in raws], results)
+    _time("extract_batch", n, len(raws), lambda: extract_plaintext_batch(raws), results)
+
+    texts = meta_texts([metas[mid] for mid in ids if mid in metas])
+    with tempfile.TemporaryDirectory() as cache_dir:
+        clusterer, backend = _time("model_load", n, 1, lambda: _make_clusterer(args.fake_embed, cache_dir, args.backend), results)
+        _time("embed_cold", n, len(texts), lambda: clusterer.embed_texts(texts), results)
+        _time("embed_cached", n, len(texts), lambda: clusterer.embed_texts(texts), results)
+        clusters = _time("hybrid_clusters", n, len(texts), lambda: clusterer.hybrid_clusters(texts), results)
+
+    # fetch and cold embed again, overlapped the way the app's scan does it; compare with metadata + embed_cold
+    with tempfile.TemporaryDirectory() as cache_dir:
+        clusterer, _ = _make_clusterer(args.fake_embed, cache_dir, args.backend)
+        fresh = GmailClient(service=service, limiter=RateLimiter(args.gmail_quota or 1e9, name="gmail"))
+        stream = (meta_texts(list(m.values())) for m in prefetch(fresh.iter_messages_meta(ids), 3))
+        _time("scan_overlapped", n, len(ids), lambda: list(clusterer.embed_stream(stream)), results)
+        # label from representative members, as the app and pipeline do
+        samples = {}
+        for cid, idx in clusters.items():
+            candidates = [texts[i] for i in evenly_spaced(idx, LABEL_CANDIDATES)]
+            samples[cid] = [candidates[i] for i in clusterer.representatives(candidates)]
+
+    claude_client.client = FakeClaudeClient(latency=args.claude_latency, throttle_rate=args.throttle_rate, seed=args.seed)
+    claude_client.limiter = RateLimiter(args.claude_rps, name="claude")
+    _time("label_clusters", n, len(samples), lambda: claude_client.label_clusters(samples), results)
+
+    half = len(ids) // 2
+    _time("bulk_archive", n, half, lambda: gmail.bulk_archive(ids[:half]), results)
+    _time("bulk_trash", n, len(ids) - half, lambda: gmail.bulk_trash(ids[half:]), results)
+    return backend
+
+
+def compare(current: Dict[str, Any], baseline_path: str, tolerance: float) -> int:
+    """Print per-stage ratios against a previous run. Returns the number of regressions."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["size"], r["stage"]): r["seconds"] for r in baseline["results"]}
+    regressions = 0
+    print(f"\ncompared with {baseline.get('revision')} ({baseline_path})")
+    for r in current["results"]:
+        before = old.get((r["size"], r["stage"]))
+        if not before:
+            continue
+        ratio = r["seconds"] / before
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"  {r['size']:>7} {r['stage']:<20} {before:8.3f}s -> {r['seconds']:8.3f}s  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark with a synthetic mailbox.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Gmail round-trip seconds")
+    parser.add_argument("--claude-latency", type=float, default=0.8, help="fake Claude response seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Gmail calls failing with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls failing with 429")
+    parser.add_argument("--gmail-quota", type=float, default=0, help="Gmail quota units per second (0 = unlimited)")
+    parser.add_argument("--claude-rps", type=float, default=4.0, help="Claude requests per second")
+    parser.add_argument("--extract-sample", type=int, default=5000, help="messages used for the extraction stages")
+    parser.add_argument("--fake-embed", action="store_true", help="use a hashing encoder instead of the model")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch", help="embedding backend for the real model")
+    parser.add_argument("--metrics", action="store_true", help="collect metrics.py instrumentation into the report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging a regression")
+    args = parser.parse_args(argv)
+
+    import metrics
+    metrics.enable(args.metrics)
+
+    results: List[Dict[str, Any]] = []
+    backend = "fake" if args.fake_embed else "model"
+    for n in args.sizes:
+        backend = run_size(n, args, results)
+
+    report = {
+        "revision": _revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "embed_backend": backend,
+        "config": vars(args),
+        "results": results,
+    }
+    if args.metrics:
+        report["metrics"] = metrics.snapshot()
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        return 1 if compare(report, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
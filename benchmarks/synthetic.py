@@ -0,0 +1,140 @@
+# benchmarks/synthetic.py
+import base64
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+# (weight, sender, subject template, snippet template, labels, bulk headers?, html body?)
+STREAMS = [
+    (20, "Daily Digest <newsletter@{domain}>", "Your {day} digest: {n} stories you missed",
+     "Top stories today include {topic} and more. Read the full digest in your browser.",
+     ["INBOX", "CATEGORY_UPDATES"], True, True),
+    (15, "{shop} <no-reply@{domain}>", "{pct}% off {product} — this weekend only",
+     "Save {pct}% on {product}. Limited time offer, sale ends {day}. Unsubscribe anytime.",
+     ["INBOX", "CATEGORY_PROMOTIONS"], True, True),
+    (12, "{shop} Orders <orders@{domain}>", "Your {shop} order #{order} has shipped",
+     "Your order #{order} of {product} is on its way. Track your package with tracking number {order}{n}.",
+     ["INBOX", "CATEGORY_UPDATES"], False, True),
+    (10, "{shop} Billing <billing@{domain}>", "Receipt for your payment of ${amount}",
+     "Thanks for your payment of ${amount} to {shop} on {day}. Your receipt is attached.",
+     ["INBOX", "CATEGORY_UPDATES"], False, False),
+    (12, "{social} <notifications@{domain}>", "{name} commented on your post",
+     "{name} commented: \"{topic} looks great!\" Reply or view the conversation on {social}.",
+     ["INBOX", "CATEGORY_SOCIAL"], True, True),
+    (8, "{team} Alerts <alerts@{domain}>", "[{team}] Build {order} failed on main",
+     "Build {order} failed for {team}/{product}. {n} tests failed in stage deploy.",
+     ["INBOX", "CATEGORY_UPDATES"], True, False),
+    (5, "Security <security@{domain}>", "Security alert: new sign-in on {device}",
+     "We noticed a new sign-in to your account from {device} on {day}. If this was you, no action is needed.",
+     ["INBOX", "IMPORTANT"], False, True),
+    (18, "{name} <{first}@{domain}>", "{topic} next {day}?",
+     "Hi, are we still on for {topic} on {day}? Let me know what time works. Thanks, {first}",
+     ["INBOX", "IMPORTANT"], False, False),
+]
+
+WORDS = {
+    "domain": ["example.com", "shopmail.net", "news.example.org", "notify.social.io", "ci.devtools.dev", "acme.co"],
+    "shop": ["Acme", "Globex", "Initech", "Umbrella", "Hooli", "Stark Supply"],
+    "product": ["running shoes", "headphones", "coffee beans", "a standing desk", "winter jackets", "phone cases"],
+    "topic": ["the quarterly review", "lunch", "the design sync", "climate policy", "AI chips", "the offsite"],
+    "day": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"],
+    "name": ["Alice Chen", "Bob Singh", "Carla Gomez", "Dan Okafor", "Eve Novak", "Farid Haddad"],
+    "social": ["Friendly", "LinkUp", "Photogram"],
+    "team": ["payments", "search", "mobile", "infra"],
+    "device": ["Chrome on Windows", "Safari on iPhone", "Firefox on Linux"],
+}
+
+
+def _fill(template: str, rng: random.Random, extra: Dict[str, str]) -> str:
+    values = {k: rng.choice(v) for k, v in WORDS.items()}
+    values.update(extra)
+    return template.format(**values)
+
+
+def _weighted_streams(rng: random.Random, n: int):
+    weights = [s[0] for s in STREAMS]
+    return rng.choices(range(len(STREAMS)), weights=weights, k=n)
+
+
+def make_mailbox(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Synthetic mailbox of n messages, newest first. Each message is a dict with
+    Gmail-like metadata ("id", "threadId", "labelIds", "snippet", "internalDate",
+    "payload": {"headers": [...]}) plus the fields needed to build its raw MIME.
+    """
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for i, stream in enumerate(_weighted_streams(rng, n)):
+        _, sender_t, subject_t, snippet_t, labels, bulk, html = STREAMS[stream]
+        extra = {
+            "n": str(rng.randint(2, 40)),
+            "pct": str(rng.choice([10, 15, 20, 25, 30, 40, 50])),
+            "order": str(rng.randint(100000, 999999)),
+            "amount": f"{rng.randint(5, 500)}.{rng.randint(0, 99):02d}",
+        }
+        extra["first"] = rng.choice(WORDS["name"]).split()[0].lower()
+        sender = _fill(sender_t, rng, extra)
+        subject = _fill(subject_t, rng, extra)
+        snippet = _fill(snippet_t, rng, extra)
+        when = now - timedelta(minutes=i * 7 + rng.randint(0, 6))
+        headers = [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Subject", "value": subject},
+            {"name": "Date", "value": format_datetime(when)},
+        ]
+        if bulk:
+            headers.append({"name": "List-Unsubscribe", "value": f"<mailto:unsubscribe@{sender.split('@')[-1].rstrip('>')}>"})
+            headers.append({"name": "Precedence", "value": "bulk"})
+        messages.append({
+            "id": f"{i:016x}",
+            "threadId": f"{i:016x}",
+            "labelIds": list(labels),
+            "snippet": snippet,
+            "internalDate": str(int(when.timestamp() * 1000)),
+            "payload": {"headers": headers},
+            "_html": html,
+            "_seed": seed * 1_000_003 + i,
+        })
+    return messages
+
+
+def make_raw(message: Dict[str, Any]) -> str:
+    """Build the base64url 'raw' MIME for a synthetic message (plain, or plain+HTML with an attachment)."""
+    rng = random.Random(message["_seed"])
+    headers = {h["name"]: h["value"] for h in message["payload"]["headers"]}
+    msg = EmailMessage()
+    for name in ("From", "To", "Subject", "Date"):
+        msg[name] = headers[name]
+    paragraphs = [message["snippet"]] + [
+        " ".join(rng.choice(WORDS["topic"]) for _ in range(rng.randint(8, 30)))
+        for _ in range(rng.randint(2, 12))
+    ]
+    msg.set_content("\n\n".join(paragraphs))
+    if message["_html"]:
+        body = "".join(f"<p>{p}</p>" for p in paragraphs)
+        msg.add_alternative(
+            f"<html><head><style>p {{ margin: 0 }}</style></head><body><table><tr><td>{body}</td></tr></table>"
+            f"<script>track()</script></body></html>",
+            subtype="html"
+        )
+        if rng.random() < 0.1:
+            msg.add_attachment(rng.randbytes(20000), maintype="application", subtype="pdf", filename="statement.pdf")
+    return base64.urlsafe_b64encode(msg.as_bytes()).decode("ascii")
+
+
+def metadata(message: Dict[str, Any]) -> Dict[str, Any]:
+    """The public (Gmail response) part of a synthetic message."""
+    return {k: v for k, v in message.items() if not k.startswith("_")}
+
+
+def meta_texts(messages: List[Dict[str, Any]]) -> List[str]:
+    """Subject + snippet texts, as the app builds them for clustering."""
+    out = []
+    for m in messages:
+        headers = {h["name"]: h["value"] for h in m["payload"]["headers"]}
+        out.append(f"Subject: {headers.get('Subject', '')}\n{m.get('snippet', '')}")
+    return out
@@ -1,36 +1,90 @@
 # claude_client.py
+import hashlib
+import json
 import os
-from typing import List, Dict, Any
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 import time
-import anthropic
 from dotenv import load_dotenv
-import os
+
+import metrics
+from prefilter import prescore, meta_text
+from utils import RateLimiter, call_with_retry, chunks
 
 load_dotenv()
 
-API_KEY = os.getenv("ANTHROPIC_API_KEY")
-if not API_KEY:
-    raise RuntimeError("Set ANTHROPIC_API_KEY environment variable")
+# Created on first use by get_client(), so importing this module needs no API key
+# (and doesn't pay for importing the SDK). The benchmarks assign a stand-in.
+client = None
+_client_lock = threading.Lock()
+
+MODEL = "claude-3-7-sonnet-20250219"
+LABEL_CACHE_PATH = "cluster_labels.json"
+SCORE_BATCH_SIZE = 20  # emails per bulk scoring request
+# Cluster labels: the sample emails share a budget of ~300 input tokens (~4 chars per
+# token), and the JSON answer (label + one sentence) fits well within LABEL_MAX_TOKENS.
+LABEL_PROMPT_CHARS = 1200
+MIN_SAMPLE_CHARS = 80
+LABEL_MAX_TOKENS = 120
+# Requests per second allowed by the account's rate-limit tier; 429/529 responses lower it further.
+REQUESTS_PER_SECOND = float(os.getenv("CLAUDE_REQUESTS_PER_SECOND", "4"))
+limiter = RateLimiter(REQUESTS_PER_SECOND, name="claude")
+
+
+def get_client():
+    """The shared Anthropic client, built on first call."""
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                api_key = os.getenv("ANTHROPIC_API_KEY")
+                if not api_key:
+                    raise RuntimeError("Set ANTHROPIC_API_KEY environment variable")
+                import anthropic
+                # retries are done by call_with_retry so they are paced by the shared limiter
+                client = anthropic.Client(api_key=api_key, max_retries=0)
+    return client
+
+
+def _create(**kwargs):
+    """All Claude calls go through here: paced by the shared limiter, retried on 429/529,
+    and recorded (requests and token usage)."""
+    with metrics.span("claude.request"):
+        response = call_with_retry(lambda: get_client().messages.create(**kwargs), limiter)
+    metrics.incr("claude.requests")
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.incr("claude.input_tokens", getattr(usage, "input_tokens", 0) or 0)
+        metrics.incr("claude.output_tokens", getattr(usage, "output_tokens", 0) or 0)
+    return response
 
-client = anthropic.Client(api_key=API_KEY)
 
 SYSTEM_PROMPT = """
 You are an assistant that reads short email text and classifies and summarizes them.
 Return JSON only when asked.
 """
 
-def summarize_cluster(cluster_texts: List[str], max_chars: int = 1200) -> str:
-    """Ask Claude to produce a short summary and a suggested label for a cluster."""
-    sample_text = "\n---\n".join(cluster_texts[:6])
-    prompt = f"{SYSTEM_PROMPT}\n\nHuman: Given the following emails (separated by '---'), produce a short label (3 words or less) and a 2-3 sentence human readable summary explaining why they were grouped. Output JSON: {{\"label\": \"...\", \"summary\": \"...\"}}.\n\nEmails:\n{sample_text}\n\nAssistant:"
-    # resp = client.completions.create(
-    #     model="claude-2.1", 
-    #     prompt=prompt, 
-    #     max_tokens_to_sample=300)
-    # return resp.completion.strip()
-    response = client.messages.create(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=512,
+def truncate(text: str, max_chars: int) -> str:
+    """Whitespace collapsed, cut at a word boundary to at most max_chars."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    return (cut.rsplit(" ", 1)[0] or cut) + "…"
+
+
+def summarize_cluster(cluster_texts: List[str], max_chars: int = LABEL_PROMPT_CHARS) -> str:
+    """Ask Claude to produce a short summary and a suggested label for a cluster.
+    cluster_texts should already be a representative sample (Clusterer.representatives);
+    together they are cut down to max_chars."""
+    per_text = max(MIN_SAMPLE_CHARS, max_chars // max(1, len(cluster_texts)))
+    sample_text = "\n---\n".join(truncate(t, per_text) for t in cluster_texts)
+    prompt = f"{SYSTEM_PROMPT}\n\nHuman: Given the following emails (separated by '---'), produce a short label (3 words or less) and a one-sentence summary (at most 25 words) explaining why they were grouped. Output JSON: {{\"label\": \"...\", \"summary\": \"...\"}}.\n\nEmails:\n{sample_text}\n\nAssistant:"
+    response = _create(
+        model=MODEL,
+        max_tokens=LABEL_MAX_TOKENS,
         messages=[
             {"role": "user", "content": f"{prompt}"}
         ]
@@ -46,11 +100,180 @@ User: For the following single email text, respond with JSON containing:
 Email:
 \"\"\"{msg_text[:3000]}\"\"\"
 Assistant:"""
-    response = client.messages.create(
-        model="claude-3-7-sonnet-20250219",
+    response = _create(
+        model=MODEL,
         max_tokens=512,
         messages=[
             {"role": "user", "content": f"{prompt}"}
         ]
     )
     return response.content[0].text
+
+
+def parse_json_response(out: str) -> Optional[Dict[str, Any]]:
+    """Claude returns text; pull out the first {...} block and parse it."""
+    m = re.search(r'\{.*\}', out, re.S)
+    if not m:
+        return None
+    try:
+        return json.loads(m.group(0))
+    except json.JSONDecodeError:
+        return None
+
+
+class LabelCache:
+    """Cluster labels persisted to a JSON file, keyed by a fingerprint of the prompt content."""
+
+    def __init__(self, path: str = LABEL_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._data = json.load(f)
+
+    @staticmethod
+    def fingerprint(sample_texts: List[str]) -> str:
+        h = hashlib.sha256(MODEL.encode("utf-8"))
+        for t in sample_texts:
+            h.update(b"\0" + t.encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            return self._data.get(key)
+
+    def put_many(self, items: Dict[str, Dict[str, str]]):
+        if not items:
+            return
+        with self._lock:
+            self._data.update(items)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f)
+            os.replace(tmp, self.path)
+
+
+@metrics.timed("claude.label_clusters")
+def label_clusters(
+    samples: Dict[int, List[str]],
+    cache: Optional[LabelCache] = None,
+    max_workers: int = 8
+) -> Dict[int, Dict[str, str]]:
+    """
+    Label many clusters at once. samples maps cluster id -> sample texts.
+    Requests run on a thread pool behind the shared limiter; identical samples are
+    answered from the cache (and sent at most once per call).
+    Returns {cluster_id: {"label": ..., "summary": ...}}. When Claude could not be
+    reached the entry is a "Cluster N" fallback marked "failed": True; show it, but
+    don't persist it, so the cluster is labeled again next time.
+    """
+    results: Dict[int, Dict[str, str]] = {}
+    todo: Dict[str, List[int]] = {}
+    for cid, texts in samples.items():
+        key = LabelCache.fingerprint(texts)
+        hit = cache.get(key) if cache is not None else None
+        if hit is not None:
+            results[cid] = hit
+            metrics.incr("label_cache.hits")
+        else:
+            todo.setdefault(key, []).append(cid)
+            metrics.incr("label_cache.misses")
+    if not todo:
+        return results
+
+    def run(key: str):
+        cid = todo[key][0]
+        try:
+            out = summarize_cluster(samples[cid])
+        except Exception as e:
+            # not cached, so it is retried next time
+            return key, {"label": f"Cluster {cid}", "summary": f"Could not call Claude: {e}", "failed": True}, False
+        parsed = parse_json_response(out)
+        if parsed is None:
+            return key, {"label": f"Cluster {cid}", "summary": out}, True
+        return key, {"label": parsed.get("label", f"Cluster {cid}"), "summary": parsed.get("summary", "")}, True
+
+    fresh: Dict[str, Dict[str, str]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for key, label, ok in pool.map(run, list(todo)):
+            for cid in todo[key]:
+                results[cid] = label
+            if ok:
+                fresh[key] = label
+    if cache is not None:
+        cache.put_many(fresh)
+    return results
+
+
+def _score_batch(batch: List[tuple], max_chars: int) -> Dict[str, Dict[str, Any]]:
+    """One request scoring several emails. batch is [(message_id, text), ...]."""
+    emails = "\n".join(
+        f"[{n}]\n\"\"\"{text[:max_chars]}\"\"\"" for n, (_, text) in enumerate(batch, start=1)
+    )
+    prompt = f"""{SYSTEM_PROMPT}
+User: For each numbered email below, rate how safe it is to DELETE it (1.0 = very safe to delete, 0.0 = definitely do not delete).
+Respond with a JSON array only, one object per email: [{{"id": <number>, "score": <float>, "reason": "<one short sentence>"}}].
+{emails}
+Assistant:"""
+    response = _create(
+        model=MODEL,
+        max_tokens=60 * len(batch) + 100,
+        messages=[
+            {"role": "user", "content": f"{prompt}"}
+        ]
+    )
+    out = response.content[0].text
+    m = re.search(r'\[.*\]', out, re.S)
+    items = json.loads(m.group(0)) if m else []
+    results: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        try:
+            mid = batch[int(item["id"]) - 1][0]
+            results[mid] = {"score": float(item["score"]), "reason": item.get("reason", ""), "source": "claude"}
+        except (KeyError, ValueError, TypeError, IndexError):
+            continue
+    return results
+
+
+def score_messages_bulk(
+    messages: Dict[str, str],
+    batch_size: int = SCORE_BATCH_SIZE,
+    max_chars: int = 600,
+    max_workers: int = 4
+) -> Dict[str, Dict[str, Any]]:
+    """Score many emails with Claude, batch_size truncated emails per request.
+    Returns {message_id: {"score", "reason", "source"}}; messages Claude skipped are absent."""
+    def run(batch):
+        try:
+            return _score_batch(batch, max_chars)
+        except Exception as e:
+            print(f"Bulk scoring failed for {len(batch)} emails: {e}")
+            return {}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for part in pool.map(run, chunks(list(messages.items()), batch_size)):
+            results.update(part)
+    return results
+
+
+@metrics.timed("claude.score_messages")
+def score_messages(metas: Dict[str, Dict[str, Any]], texts: Optional[Dict[str, str]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Safe-delete scores for a whole set of messages (Gmail metadata responses).
+    Obvious cases are settled locally by prefilter.prescore; only the rest go
+    to Claude, using texts[mid] when given and the metadata text otherwise.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    ambiguous: Dict[str, str] = {}
+    for mid, meta in metas.items():
+        local = prescore(meta)
+        if local is not None:
+            results[mid] = local
+            metrics.incr("prefilter.settled")
+        else:
+            ambiguous[mid] = (texts or {}).get(mid) or meta_text(meta)
+    if ambiguous:
+        results.update(score_messages_bulk(ambiguous))
+    return results
@@ -0,0 +1,132 @@
+# dedup.py
+import hashlib
+import re
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Hamming distance (out of 64 bits) under which two SimHashes count as near-duplicates.
+# The hash is split into MAX_DISTANCE + 1 bands; two hashes that close always agree
+# exactly on at least one band (pigeonhole), so only texts sharing a band bucket
+# are ever compared.
+MAX_DISTANCE = 3
+SHINGLE = 2  # words per shingle
+
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_EMAIL = re.compile(r"\S+@\S+")
+_NUMBER = re.compile(r"\d+(?:[.,:/-]\d+)*")
+_WORD = re.compile(r"\w+")
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, with URLs, addresses and numbers (dates, order ids, amounts) masked out."""
+    text = _URL.sub(" url ", text.lower())
+    text = _EMAIL.sub(" email ", text)
+    text = _NUMBER.sub("0", text)
+    return " ".join(_WORD.findall(text))
+
+
+def _hash64(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class DuplicateIndex:
+    """
+    Groups texts that are exact duplicates after normalize_text, or near
+    duplicates by SimHash over word shingles (receipts, notifications and
+    newsletters that differ only in a date, a name or a number).
+
+    Texts are added one at a time, so it works on a stream as well as a list.
+    labels[i] is the group of the i-th text added; representatives[g] is the
+    position of the first text of group g and sizes[g] its member count.
+    """
+
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self._band_bits = 64 // self.bands
+        self.labels: List[int] = []
+        self.representatives: List[int] = []
+        self.sizes: List[int] = []
+        self._exact: Dict[str, int] = {}
+        self._hashes: List[int] = []              # simhash per group
+        self._buckets: Dict[tuple, List[int]] = {}  # (band, value) -> groups
+        self._token_hashes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def n_groups(self) -> int:
+        return len(self.sizes)
+
+    def simhash(self, normalized: str) -> int:
+        words = normalized.split()
+        shingles = [" ".join(words[i:i + SHINGLE]) for i in range(max(1, len(words) - SHINGLE + 1))]
+        hashes = []
+        for sh in shingles:
+            h = self._token_hashes.get(sh)
+            if h is None:
+                h = self._token_hashes[sh] = _hash64(sh)
+            hashes.append(h)
+        bits = (np.asarray(hashes, dtype=np.uint64)[:, None] >> _BITS) & np.uint64(1)
+        votes = bits.sum(axis=0).astype(np.int64) * 2 - len(hashes)
+        return int(((votes > 0).astype(np.uint64) << _BITS).sum())
+
+    def _bands(self, h: int):
+        mask = (1 << self._band_bits) - 1
+        return [(b, (h >> (b * self._band_bits)) & mask) for b in range(self.bands)]
+
+    def add(self, text: str) -> int:
+        """Add one text and return its group id."""
+        normalized = normalize_text(text)
+        key = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        group = self._exact.get(key)
+        if group is None:
+            h = self.simhash(normalized)
+            bands = self._bands(h)
+            for band in bands:
+                for g in self._buckets.get(band, ()):
+                    if bin(self._hashes[g] ^ h).count("1") <= self.max_distance:
+                        group = g
+                        break
+                if group is not None:
+                    break
+            if group is None:
+                group = len(self.sizes)
+                self.representatives.append(len(self.labels))
+                self.sizes.append(0)
+                self._hashes.append(h)
+                for band in bands:
+                    self._buckets.setdefault(band, []).append(group)
+            self._exact[key] = group
+        self.sizes[group] += 1
+        self.labels.append(group)
+        return group
+
+    def add_many(self, texts: Iterable[str]) -> List[int]:
+        return [self.add(t) for t in texts]
+
+    def expand(self, group_clusters: Dict[int, List[int]], groups: Optional[List[int]] = None) -> Dict[int, List[int]]:
+        """
+        Turn clusters over groups into clusters over texts. group_clusters holds
+        positions into `groups` (default: every group, in id order, which is the
+        order of `representatives`). Members keep the order they were added in.
+        """
+        groups = groups if groups is not None else list(range(self.n_groups))
+        cluster_of = np.full(self.n_groups, -1, dtype=np.int64)
+        for cid, positions in group_clusters.items():
+            cluster_of[[groups[p] for p in positions]] = cid
+        out: Dict[int, List[int]] = {cid: [] for cid in group_clusters}
+        for i, g in enumerate(self.labels):
+            cid = cluster_of[g]
+            if cid >= 0:
+                out[int(cid)].append(i)
+        return out
+
+
+def group_duplicates(texts: List[str], max_distance: int = MAX_DISTANCE) -> DuplicateIndex:
+    index = DuplicateIndex(max_distance)
+    index.add_many(texts)
+    return index
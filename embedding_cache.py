@@ -0,0 +1,144 @@
+# embedding_cache.py
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+CACHE_DIR = ".embedding_cache"
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock shared by every process using the cache directory."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache.
+
+    Vectors are keyed by sha1(model name + text). Recently used vectors stay in
+    an in-memory LRU of at most `max_memory_items`; every vector is also
+    appended to a float32 file on disk that is read back through np.memmap, so
+    the cache survives restarts without loading the whole matrix into RAM.
+
+    keys.txt holds "<key> <row>" per vector. Rows are taken from the size of
+    the vector file under a file lock, so several processes can share the
+    cache, and a crash between the two appends only leaves a vector without a
+    key, which is cut off on the next load.
+    """
+
+    def __init__(self, model_name: str, dim: int, cache_dir: str = CACHE_DIR, max_memory_items: int = 50000):
+        self.model_name = model_name
+        self.dim = dim
+        self.max_memory_items = max_memory_items
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        root = os.path.join(cache_dir, safe_name)
+        os.makedirs(root, exist_ok=True)
+        self.vec_path = os.path.join(root, "vectors.f32")
+        self.key_path = os.path.join(root, "keys.txt")
+        self.lock_path = os.path.join(root, "lock")
+        self.row_bytes = 4 * dim
+
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._rows: Dict[str, int] = {}
+        self._n_rows = 0  # vectors on disk this process knows to be complete
+        self._mmap: Optional[np.memmap] = None
+        self._load_index()
+
+    def _load_index(self):
+        with _file_lock(self.lock_path):
+            if not os.path.exists(self.vec_path):
+                return
+            n_vectors = os.path.getsize(self.vec_path) // self.row_bytes
+            key_bytes = 0  # end of the last complete line of keys.txt
+            if os.path.exists(self.key_path):
+                with open(self.key_path, "rb") as f:
+                    for line_no, line in enumerate(f):
+                        if not line.endswith(b"\n"):
+                            break  # half-written line
+                        parts = line.decode("ascii").split()
+                        # caches written before rows were stored hold one key per line, in row order
+                        row = int(parts[1]) if len(parts) == 2 else line_no
+                        if parts and row < n_vectors:
+                            self._rows[parts[0]] = row
+                        key_bytes += len(line)
+                if key_bytes != os.path.getsize(self.key_path):
+                    os.truncate(self.key_path, key_bytes)
+            # a partial vector, or vectors whose keys were never written, can only be at the end
+            self._n_rows = max(self._rows.values(), default=-1) + 1
+            if os.path.getsize(self.vec_path) != self._n_rows * self.row_bytes:
+                os.truncate(self.vec_path, self._n_rows * self.row_bytes)
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _disk_view(self) -> Optional[np.memmap]:
+        n = self._n_rows
+        if n == 0:
+            return None
+        if self._mmap is None or self._mmap.shape[0] < n:
+            self._mmap = np.memmap(self.vec_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+        return self._mmap
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up vectors; None marks a miss."""
+        out: List[Optional[np.ndarray]] = []
+        with self._lock:
+            disk = None
+            for k in keys:
+                vec = self._mem.get(k)
+                if vec is not None:
+                    self._mem.move_to_end(k)
+                elif k in self._rows:
+                    if disk is None:
+                        disk = self._disk_view()
+                    vec = np.array(disk[self._rows[k]])
+                    self._remember(k, vec)
+                out.append(vec)
+        return out
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            new = list({k: v for k, v in zip(keys, vectors) if k not in self._rows}.items())
+            if new:
+                with _file_lock(self.lock_path):
+                    with open(self.vec_path, "ab") as f:
+                        # the file, not this process, says where the next row goes
+                        start = os.fstat(f.fileno()).st_size // self.row_bytes
+                        f.truncate(start * self.row_bytes)  # drop a partial vector left by a crash
+                        f.write(np.stack([v for _, v in new]).tobytes())
+                    with open(self.key_path, "a", encoding="ascii") as f:
+                        f.write("".join(f"{k} {start + offset}\n" for offset, (k, _) in enumerate(new)))
+                for offset, (k, _) in enumerate(new):
+                    self._rows[k] = start + offset
+                self._n_rows = max(self._n_rows, start + len(new))
+            for k, v in zip(keys, vectors):
+                self._remember(k, v)
+
+    def _remember(self, key: str, vec: np.ndarray):
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_memory_items:
+            self._mem.popitem(last=False)
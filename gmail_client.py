@@ -2,21 +2,90 @@
 import base64
 import os
 import pickle
-from typing import List, Dict, Any
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+import metrics
+from mailbox_store import MailboxStore
+from utils import RateLimiter, backoff_delay, call_with_retry, chunks, is_retryable_error, is_throttle_error
+
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify'
 ]
 TOKEN_PICKLE = "token.pickle"
 CREDENTIALS_FILE = "credentials.json"
 
+META_HEADERS = ['From', 'To', 'Subject', 'Date', 'List-Unsubscribe', 'List-Id', 'Precedence']
+# Only ask Gmail for what the UI actually uses; keeps each batch response small.
+META_FIELDS = "id,threadId,labelIds,snippet,internalDate,payload/headers"
+HISTORY_FIELDS = (
+    "history(messagesAdded/message/id,messagesDeleted/message/id,"
+    "labelsAdded(message/id,labelIds),labelsRemoved(message/id,labelIds)),"
+    "historyId,nextPageToken"
+)
+# Listing only needs ids; resultSizeEstimate tells how finely to split a date range.
+LIST_FIELDS = "messages/id,nextPageToken,resultSizeEstimate"
+LIST_PAGE_SIZE = 500  # messages.list maximum
+# Listings expected to need more pages than this are split into after:/before: date
+# ranges that are listed concurrently; smaller ones page through a single range.
+PARALLEL_LIST_PAGES = 10
+LIST_WORKERS = 16             # enough to keep the 250 units/s quota busy at ~300ms per call
+LIST_PARTITIONS = 8           # initial date ranges; busy ranges are split further
+LIST_EPOCH = 1072915200       # 2004-01-01, before Gmail existed
+LIST_MIN_SPAN = 6 * 3600      # ranges narrower than this are paged instead of split
+LIST_RANGE_PAGES = 4          # pages a range may hold before it is split
+LIST_MAX_SPLIT = 64           # parts a range is split into at most
+GMAIL_BATCH_LIMIT = 100  # hard limit of sub-requests per HTTP batch
+BATCH_MODIFY_LIMIT = 1000  # max ids per users.messages.batchModify call
+
+# Gmail quota: 250 units per user per second, each method has a fixed unit cost.
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+GMAIL_QUOTA_COSTS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.trash": 5,
+    "messages.batchModify": 50,
+    "messages.batchDelete": 50,
+    "history.list": 2,
+    "users.getProfile": 1,
+}
+# One bucket for the whole process: the quota is per user, not per client or thread.
+GMAIL_LIMITER = RateLimiter(GMAIL_QUOTA_UNITS_PER_SECOND, name="gmail")
+
 
 class GmailClient:
-    def __init__(self):
+    def __init__(self, store: Optional[MailboxStore] = None, service=None, limiter: Optional[RateLimiter] = None):
+        """If a MailboxStore is given, listing and metadata reads are served from it
+        and kept current through the Gmail history API. Passing a ready-made
+        `service` skips OAuth (used by the offline benchmarks); otherwise OAuth
+        runs on first use of `service`, not here. Every call is paced by
+        `limiter`, the shared GMAIL_LIMITER unless one is given."""
+        self.store = store
+        self.limiter = limiter or GMAIL_LIMITER
+        self._local = threading.local()
+        self.creds = None
+        self._service = service
+        self._connect_lock = threading.Lock()
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self._connect_lock:
+                if self._service is None:
+                    self._connect()
+        return self._service
+
+    def _connect(self):
+        """Load or obtain OAuth credentials and build the Gmail resource."""
         creds = None
         if os.path.exists(TOKEN_PICKLE):
             with open(TOKEN_PICKLE, "rb") as f:
@@ -26,41 +95,338 @@ class GmailClient:
             creds = flow.run_local_server(port=0)
             with open(TOKEN_PICKLE, "wb") as f:
                 pickle.dump(creds, f)
-        self.service = build("gmail", "v1", credentials=creds)
+        self.creds = creds
+        self._service = build("gmail", "v1", credentials=creds)
 
-    def list_message_ids(self, query: str = "", max_results: int = 5000) -> List[str]:
-        """Return list of message ids matching query (empty query returns all)."""
-        msgs = []
+    def _http(self):
+        """httplib2 is not thread-safe, so every worker thread gets its own authorized transport."""
+        if self.creds is None:
+            return None
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    def _execute(self, endpoint: str, request):
+        """Run one API request on this thread's transport, paced by the quota limiter and
+        retried on throttling or transient errors. Records the call and payload size."""
+        def run():
+            metrics.incr(f"gmail.calls.{endpoint}")
+            return request.execute(http=self._http())
+        response = call_with_retry(run, self.limiter, GMAIL_QUOTA_COSTS.get(endpoint, 5))
+        metrics.add_json_bytes("gmail.bytes_received", response)
+        return response
+
+    def _list_ids(self, query: str, max_results: int) -> Tuple[List[str], bool]:
+        """List ids newest first. Returns (ids, exhausted) where exhausted means no pages were left."""
         try:
-            response = self.service.users().messages().list(userId='me', q=query, maxResults=500).execute()
-            while response:
-                if "messages" in response:
-                    msgs.extend([m["id"] for m in response["messages"]])
-                if "nextPageToken" in response and len(msgs) < max_results:
-                    response = self.service.users().messages().list(userId='me', q=query, pageToken=response["nextPageToken"], maxResults=500).execute()
-                else:
+            if max_results > PARALLEL_LIST_PAGES * LIST_PAGE_SIZE:
+                return self._list_partitioned(query, max_results)
+            return self._list_pages(query, max_results)
+        except HttpError as error:
+            print("Gmail list error:", error)
+            return [], False
+
+    def _list_page(self, query: str, page_token: Optional[str] = None) -> Dict[str, Any]:
+        return self._execute("messages.list", self.service.users().messages().list(
+            userId='me', q=query, pageToken=page_token, maxResults=LIST_PAGE_SIZE, fields=LIST_FIELDS))
+
+    def _list_pages(self, query: str, max_results: int, response: Optional[Dict[str, Any]] = None) -> Tuple[List[str], bool]:
+        """Page through messages.list, optionally continuing from an already fetched first page."""
+        msgs = []
+        response = response if response is not None else self._list_page(query)
+        while True:
+            msgs.extend(m["id"] for m in response.get("messages", []))
+            if "nextPageToken" not in response:
+                return msgs[:max_results], True
+            if len(msgs) >= max_results:
+                return msgs[:max_results], False
+            response = self._list_page(query, response["nextPageToken"])
+
+    def _list_range(self, query: str, after: Optional[int], before: Optional[int], max_results: int):
+        """One date range (None = open-ended): the number of parts to split it into when it
+        looks bigger than LIST_RANGE_PAGES pages and is wide enough to split, otherwise
+        (ids, exhausted). Open-ended ranges are never split."""
+        # widened by a second on both sides; the overlap is removed when ranges are merged
+        bounds = ([f"after:{after - 1}"] if after is not None else []) + ([f"before:{before + 1}"] if before is not None else [])
+        ranged = " ".join([query] + bounds).strip()
+        response = self._list_page(ranged)
+        estimate = int(response.get("resultSizeEstimate", 0))
+        if ("nextPageToken" in response and estimate > LIST_RANGE_PAGES * LIST_PAGE_SIZE
+                and after is not None and before is not None and before - after > LIST_MIN_SPAN):
+            return min(LIST_MAX_SPLIT, -(-estimate // (LIST_RANGE_PAGES * LIST_PAGE_SIZE)))
+        return self._list_pages(ranged, max_results, response)
+
+    def _list_partitioned(self, query: str, max_results: int) -> Tuple[List[str], bool]:
+        """
+        List by date instead of by page token: the time since LIST_EPOCH is cut into
+        after:/before: ranges (epoch seconds) that are listed concurrently, plus an
+        open-ended range on each side for mail dated in the future or before
+        LIST_EPOCH (imports, broken Date headers). A range
+        whose first page estimates more than LIST_RANGE_PAGES pages is split again
+        by that estimate, the rest are paged through. Newer ranges are started first
+        and listing stops once the newest finished ranges hold max_results ids;
+        ranges are merged newest first with duplicates removed.
+        """
+        now = int(time.time()) + 86400
+        step = -(-(now - LIST_EPOCH) // LIST_PARTITIONS)
+        # newest first; each entry is [after, before, state], state being None (not
+        # started), a Future, or the finished (ids, exhausted)
+        ranges = ([[now, None, None]]
+                  + [[max(LIST_EPOCH, b - step), b, None] for b in range(now, LIST_EPOCH, -step)]
+                  + [[None, LIST_EPOCH, None]])
+        running = {}
+        with ThreadPoolExecutor(max_workers=LIST_WORKERS) as pool:
+            while True:
+                for r in ranges:
+                    if len(running) >= LIST_WORKERS:
+                        break
+                    if r[2] is None:
+                        r[2] = pool.submit(self._list_range, query, r[0], r[1], max_results)
+                        running[r[2]] = r
+                if not running:
                     break
-                if len(msgs) >= max_results:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    r = running.pop(future)
+                    result = future.result()
+                    if isinstance(result, tuple):
+                        r[2] = result
+                        continue
+                    # split into `result` parts, newest first
+                    width = -(-(r[1] - r[0]) // result)
+                    parts = [[max(r[0], b - width), b, None] for b in range(r[1], r[0], -width)]
+                    i = next(n for n, x in enumerate(ranges) if x is r)
+                    ranges[i:i + 1] = parts
+                found = 0
+                for r in ranges:
+                    if not isinstance(r[2], tuple):
+                        break
+                    found += len(r[2][0])
+                if found >= max_results:
+                    for future in running:
+                        future.cancel()
                     break
+
+        ids, seen, exhausted = [], set(), True
+        for r in ranges:
+            if not isinstance(r[2], tuple):
+                exhausted = False
+                break
+            range_ids, range_exhausted = r[2]
+            exhausted = exhausted and range_exhausted
+            for mid in range_ids:
+                if mid not in seen:
+                    seen.add(mid)
+                    ids.append(mid)
+        metrics.incr("gmail.list_ranges", len(ranges))
+        if len(ids) >= max_results:
+            return ids[:max_results], False
+        return ids, exhausted
+
+    @metrics.timed("gmail.list")
+    def list_message_ids(self, query: str = "", max_results: int = 5000) -> List[str]:
+        """Return list of message ids matching query (empty query returns all).
+        With a store, an unfiltered listing is answered locally after a history sync."""
+        if self.store is None:
+            return self._list_ids(query, max_results)[0]
+
+        synced = self.sync_store()
+        if query:
+            # history can't be filtered by a search query; ids are cheap, metadata still comes from the store
+            return self._list_ids(query, max_results)[0]
+        if synced:
+            ids = self.store.list_ids(max_results)
+            if self.store.is_complete() or len(ids) >= max_results:
+                return ids
+
+        # cold start: remember where history starts *before* listing so nothing is missed
+        history_id = None if synced else self._current_history_id()
+        ids, exhausted = self._list_ids(query, max_results)
+        self.store.add_ids(ids)
+        self.store.set_complete(exhausted)
+        if history_id:
+            self.store.set_history_id(history_id)
+        return ids
+
+    def _current_history_id(self) -> Optional[str]:
+        try:
+            return self._execute("users.getProfile", self.service.users().getProfile(userId='me', fields='historyId')).get("historyId")
         except HttpError as error:
-            print("Gmail list error:", error)
-        return msgs[:max_results]
+            print("Gmail profile error:", error)
+            return None
+
+    @metrics.timed("gmail.history_sync")
+    def sync_store(self) -> bool:
+        """Apply everything that changed since the store's last historyId.
+        Returns False when there is nothing to sync from (cold store or expired history).
+        Any other error leaves the store and its historyId as they were and returns True:
+        the stored listing is served as is, and the next sync retries from the same point."""
+        if self.store is None:
+            return False
+        start = self.store.get_history_id()
+        if not start:
+            return False
+
+        added = set()
+        deleted = set()
+        label_changes: Dict[str, Dict[str, List[str]]] = {}
+        latest = start
+        page_token = None
+        while True:
+            try:
+                resp = self._execute("history.list", self.service.users().history().list(
+                    userId='me', startHistoryId=start, pageToken=page_token,
+                    maxResults=500, fields=HISTORY_FIELDS
+                ))
+            except HttpError as error:
+                if error.resp.status == 404:
+                    # historyId too old: Gmail only keeps about a week of history
+                    print("Gmail history expired, rebuilding local store")
+                    self.store.reset()
+                    return False
+                print("Gmail history error, serving the local store unchanged:", error)
+                return True
+            for record in resp.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    mid = item["message"]["id"]
+                    added.add(mid)
+                    deleted.discard(mid)
+                for item in record.get("messagesDeleted", []):
+                    mid = item["message"]["id"]
+                    deleted.add(mid)
+                    added.discard(mid)
+                for key, op in (("labelsAdded", "add"), ("labelsRemoved", "remove")):
+                    for item in record.get(key, []):
+                        delta = label_changes.setdefault(item["message"]["id"], {"add": [], "remove": []})
+                        delta[op].extend(item.get("labelIds", []))
+            latest = resp.get("historyId", latest)
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+
+        if deleted:
+            self.store.delete_messages(deleted)
+        self.store.update_labels({mid: d for mid, d in label_changes.items() if mid not in added and mid not in deleted})
+        if added:
+            self.store.upsert_messages(self._fetch_messages_meta(list(added)).values())
+        self.store.set_history_id(latest)
+        return True
 
     def get_message_meta(self, message_id: str) -> Dict[str, Any]:
         """Get metadata fields (snippet, headers) without fetching full raw body by default."""
-        msg = self.service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=['From', 'To', 'Subject', 'Date']).execute()
+        msg = self._execute("messages.get", self.service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=META_HEADERS))
         return msg
 
+    def _fetch_meta_batch(self, message_ids: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        """Fetch one HTTP batch of metadata. Returns (results, ids worth retrying)."""
+        results: Dict[str, Any] = {}
+        retry: List[str] = []
+        throttled: List[str] = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                metrics.add_json_bytes("gmail.bytes_received", response)
+            elif is_retryable_error(exception):
+                retry.append(request_id)
+                if is_throttle_error(exception):
+                    throttled.append(request_id)
+            else:
+                print(f"Failed to fetch metadata for {request_id}: {exception}")
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for mid in message_ids:
+            batch.add(
+                self.service.users().messages().get(
+                    userId='me', id=mid, format='metadata',
+                    metadataHeaders=META_HEADERS, fields=META_FIELDS
+                ),
+                request_id=mid
+            )
+        # sub-requests are charged individually against the quota
+        self.limiter.acquire(GMAIL_QUOTA_COSTS["messages.get"] * len(message_ids))
+        metrics.incr("gmail.calls.batch")
+        metrics.incr("gmail.calls.messages.get", len(message_ids))
+        try:
+            batch.execute(http=self._http())
+        except Exception as e:
+            # transport-level failure: the whole batch is retried
+            print(f"Metadata batch failed: {e}")
+            if is_throttle_error(e):
+                self.limiter.on_throttle()
+            return results, [mid for mid in message_ids if mid not in results]
+        if throttled:
+            self.limiter.on_throttle()
+        else:
+            self.limiter.on_success()
+        return results, retry
+
+    def get_messages_meta(self, message_ids: List[str], **kwargs) -> Dict[str, Dict[str, Any]]:
+        """Bulk metadata lookup. Served from the store when there is one; only misses hit Gmail.
+        Returns {message_id: metadata} for every message that could be fetched."""
+        if self.store is None:
+            with metrics.span("gmail.metadata"):
+                return self._fetch_messages_meta(message_ids, **kwargs)
+        results = self.store.get_messages_meta(message_ids)
+        missing = [mid for mid in message_ids if mid not in results]
+        metrics.incr("mailbox_store.hits", len(results))
+        metrics.incr("mailbox_store.misses", len(missing))
+        if missing:
+            with metrics.span("gmail.metadata"):
+                fetched = self._fetch_messages_meta(missing, **kwargs)
+            self.store.upsert_messages(fetched.values())
+            results.update(fetched)
+        return results
+
+    def iter_messages_meta(self, message_ids: List[str], chunk_size: int = 4 * GMAIL_BATCH_LIMIT, **kwargs) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """get_messages_meta in chunks, yielded as soon as each one arrives so callers
+        can start work before the whole listing is fetched. Chunks keep the order of message_ids."""
+        for part in chunks(message_ids, chunk_size):
+            metas = self.get_messages_meta(part, **kwargs)
+            yield {mid: metas[mid] for mid in part if mid in metas}
+
+    def _fetch_messages_meta(
+        self,
+        message_ids: List[str],
+        batch_size: int = GMAIL_BATCH_LIMIT,
+        max_workers: int = 4,
+        max_retries: int = 5
+    ) -> Dict[str, Dict[str, Any]]:
+        """Bulk version of get_message_meta using Gmail HTTP batch requests.
+        Several batches run concurrently behind the quota limiter; failed sub-requests
+        are retried with jittered backoff."""
+        batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+        results: Dict[str, Dict[str, Any]] = {}
+        pending = list(dict.fromkeys(message_ids))
+        attempt = 0
+        while pending:
+            if attempt:
+                if attempt > max_retries:
+                    print(f"Giving up on metadata for {len(pending)} messages")
+                    break
+                metrics.incr("gmail.retries", len(pending))
+                time.sleep(backoff_delay(attempt))
+            failed: List[str] = []
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for ok, retry in pool.map(self._fetch_meta_batch, chunks(pending, batch_size)):
+                    results.update(ok)
+                    failed.extend(retry)
+            pending = failed
+            attempt += 1
+        return results
+
     def get_message_raw(self, message_id: str) -> Dict[str, Any]:
         """Get full raw message (MIME) for processing."""
-        return self.service.users().messages().get(userId='me', id=message_id, format='raw').execute()
+        return self._execute("messages.get", self.service.users().messages().get(userId='me', id=message_id, format='raw'))
 
     def batch_delete(self, message_ids: List[str]) -> Dict[str, Any]:
         """Batch delete messages (permanently remove)."""
         if not message_ids:
             return {"status": "no-op"}
         body = {"ids": message_ids}
-        return self.service.users().messages().batchDelete(userId="me", body=body).execute()
+        return self._execute("messages.batchDelete", self.service.users().messages().batchDelete(userId="me", body=body))
 
     def modify_labels(self, message_id: str, labels_to_add=None, labels_to_remove=None):
         body = {}
@@ -68,7 +434,7 @@ class GmailClient:
             body["addLabelIds"] = labels_to_add
         if labels_to_remove:
             body["removeLabelIds"] = labels_to_remove
-        return self.service.users().messages().modify(userId="me", id=message_id, body=body).execute()
+        return self._execute("messages.modify", self.service.users().messages().modify(userId="me", id=message_id, body=body))
 
     def move_to_trash(self, message_ids: List[str]) -> tuple[int, int]:
         """Move messages to trash by adding TRASH label and removing INBOX label.
@@ -77,10 +443,10 @@ class GmailClient:
         failure_count = 0
         for mid in message_ids:
             try:
-                self.service.users().messages().trash(
+                self._execute("messages.trash", self.service.users().messages().trash(
                     userId='me',
                     id=mid
-                ).execute()
+                ))
                 success_count += 1
                 print(f"Successfully moved {mid} to trash")
             except Exception as e:
@@ -102,4 +468,62 @@ class GmailClient:
                 failure_count += 1
                 print(f"Failed to archive {mid}: {e}")
         return success_count, failure_count
-    
\ No newline at end of file
+    
+
+    def _batch_modify_chunk(self, message_ids: List[str], add: List[str], remove: List[str]) -> Tuple[List[str], List[str]]:
+        """batchModify one chunk (throttling is retried by _execute). The call is all-or-nothing,
+        so if it still fails the chunk is replayed message by message to find exactly which ids fail."""
+        body = {"ids": message_ids, "addLabelIds": add, "removeLabelIds": remove}
+        try:
+            self._execute("messages.batchModify", self.service.users().messages().batchModify(userId="me", body=body))
+            return list(message_ids), []
+        except Exception as e:
+            print(f"batchModify failed for {len(message_ids)} messages: {e}")
+
+        succeeded, failed = [], []
+        for mid in message_ids:
+            try:
+                self._execute("messages.modify", self.service.users().messages().modify(
+                    userId="me", id=mid, body={"addLabelIds": add, "removeLabelIds": remove}
+                ))
+                succeeded.append(mid)
+            except Exception as e:
+                print(f"Failed to modify {mid}: {e}")
+                failed.append(mid)
+        return succeeded, failed
+
+    def bulk_modify_labels(
+        self,
+        message_ids: List[str],
+        labels_to_add: Optional[List[str]] = None,
+        labels_to_remove: Optional[List[str]] = None,
+        chunk_size: int = BATCH_MODIFY_LIMIT,
+        max_workers: int = 4
+    ) -> Tuple[List[str], List[str]]:
+        """Apply a label change to many messages with concurrent batchModify calls.
+        Returns (succeeded_ids, failed_ids)."""
+        add = labels_to_add or []
+        remove = labels_to_remove or []
+        chunk_size = max(1, min(chunk_size, BATCH_MODIFY_LIMIT))
+        succeeded: List[str] = []
+        failed: List[str] = []
+        with metrics.span("gmail.bulk_modify"), ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(self._batch_modify_chunk, chunk, add, remove)
+                for chunk in chunks(list(dict.fromkeys(message_ids)), chunk_size)
+            ]
+            for fut in futures:
+                ok, bad = fut.result()
+                succeeded.extend(ok)
+                failed.extend(bad)
+        if self.store is not None and succeeded:
+            self.store.update_labels({mid: {"add": add, "remove": remove} for mid in succeeded})
+        return succeeded, failed
+
+    def bulk_trash(self, message_ids: List[str], **kwargs) -> Tuple[List[str], List[str]]:
+        """Bulk equivalent of move_to_trash. Returns (succeeded_ids, failed_ids)."""
+        return self.bulk_modify_labels(message_ids, labels_to_add=["TRASH"], labels_to_remove=["INBOX"], **kwargs)
+
+    def bulk_archive(self, message_ids: List[str], **kwargs) -> Tuple[List[str], List[str]]:
+        """Bulk equivalent of archive_messages. Returns (succeeded_ids, failed_ids)."""
+        return self.bulk_modify_labels(message_ids, labels_to_remove=["INBOX"], **kwargs)
@@ -0,0 +1,172 @@
+# mailbox_store.py
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+STORE_PATH = "mailbox.db"
+# Messages carrying these labels are kept in the store but not listed.
+HIDDEN_LABELS = {"TRASH", "SPAM"}
+
+
+class MailboxStore:
+    """Local SQLite copy of message ids, headers, snippets and labels.
+
+    Rows are stored in the same shape Gmail returns for format='metadata', so
+    callers can't tell a cached message from a freshly fetched one. The store
+    also remembers the last synced historyId so GmailClient can bring it up to
+    date with users.history.list instead of listing everything again.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # Streamlit reruns the script on different threads; all access goes through the lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                thread_id TEXT,
+                internal_date INTEGER DEFAULT 0,
+                labels TEXT DEFAULT '[]',
+                snippet TEXT,
+                headers TEXT,
+                fetched INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_date ON messages(internal_date DESC);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self._conn.commit()
+
+    # -----------------------------
+    # SYNC STATE
+    # -----------------------------
+    def _get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state(key, value) VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def get_history_id(self) -> Optional[str]:
+        return self._get_state("history_id")
+
+    def set_history_id(self, history_id: str):
+        self._set_state("history_id", str(history_id))
+
+    def is_complete(self) -> bool:
+        """True once the whole mailbox has been listed into the store."""
+        return self._get_state("complete") == "1"
+
+    def set_complete(self, complete: bool = True):
+        self._set_state("complete", "1" if complete else "0")
+
+    def reset(self):
+        """Forget everything, e.g. when Gmail reports the historyId is too old."""
+        with self._lock:
+            self._conn.execute("DELETE FROM messages")
+            self._conn.execute("DELETE FROM state")
+            self._conn.commit()
+
+    # -----------------------------
+    # WRITES
+    # -----------------------------
+    def add_ids(self, message_ids: Iterable[str]):
+        """Record listed ids whose metadata has not been fetched yet."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO messages(id) VALUES (?)",
+                ((mid,) for mid in message_ids)
+            )
+            self._conn.commit()
+
+    def upsert_messages(self, metas: Iterable[Dict[str, Any]]):
+        """Store Gmail metadata responses (format='metadata')."""
+        rows = [
+            (
+                m["id"],
+                m.get("threadId"),
+                int(m.get("internalDate", 0) or 0),
+                json.dumps(m.get("labelIds", [])),
+                m.get("snippet", ""),
+                json.dumps(m.get("payload", {}).get("headers", [])),
+            )
+            for m in metas
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages(id, thread_id, internal_date, labels, snippet, headers, fetched) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1)",
+                rows
+            )
+            self._conn.commit()
+
+    def delete_messages(self, message_ids: Iterable[str]):
+        with self._lock:
+            self._conn.executemany("DELETE FROM messages WHERE id=?", ((mid,) for mid in message_ids))
+            self._conn.commit()
+
+    def update_labels(self, changes: Dict[str, Dict[str, List[str]]]):
+        """Apply label deltas: {message_id: {"add": [...], "remove": [...]}}."""
+        if not changes:
+            return
+        with self._lock:
+            ids = list(changes)
+            current = {}
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                q = "SELECT id, labels FROM messages WHERE id IN (%s)" % ",".join("?" * len(part))
+                current.update({mid: json.loads(labels) for mid, labels in self._conn.execute(q, part)})
+            updates = []
+            for mid, delta in changes.items():
+                if mid not in current:
+                    continue
+                removed = set(delta.get("remove", []))
+                labels = [l for l in current[mid] if l not in removed]
+                labels += [l for l in delta.get("add", []) if l not in labels]
+                updates.append((json.dumps(labels), mid))
+            self._conn.executemany("UPDATE messages SET labels=? WHERE id=?", updates)
+            self._conn.commit()
+
+    # -----------------------------
+    # READS
+    # -----------------------------
+    def list_ids(self, max_results: Optional[int] = None) -> List[str]:
+        """Visible message ids, newest first (ids not fetched yet sort last)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, labels FROM messages ORDER BY internal_date DESC"
+            ).fetchall()
+        ids = [mid for mid, labels in rows if not HIDDEN_LABELS.intersection(json.loads(labels))]
+        return ids[:max_results] if max_results else ids
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def get_messages_meta(self, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Return cached metadata in Gmail's response shape; ids not fetched yet are omitted."""
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for i in range(0, len(message_ids), 500):
+                part = message_ids[i:i + 500]
+                q = ("SELECT id, thread_id, internal_date, labels, snippet, headers FROM messages "
+                     "WHERE fetched=1 AND id IN (%s)" % ",".join("?" * len(part)))
+                for mid, thread_id, internal_date, labels, snippet, headers in self._conn.execute(q, part):
+                    out[mid] = {
+                        "id": mid,
+                        "threadId": thread_id,
+                        "internalDate": str(internal_date),
+                        "labelIds": json.loads(labels),
+                        "snippet": snippet,
+                        "payload": {"headers": json.loads(headers)},
+                    }
+        return out
@@ -0,0 +1,139 @@
+# message_table.py
+import itertools
+import sys
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from prefilter import header_map
+
+NO_CLUSTER = -1
+_VERSIONS = itertools.count()  # shared, so versions of different tables never collide
+
+
+class MessageTable:
+    """
+    Columnar in-memory store for the messages of one scan, used by the app in
+    place of a dict per message plus parallel text/id lists per cluster.
+
+    Every message gets a row number that never changes: string columns are
+    plain lists (ids and senders interned, since they repeat), the cluster of
+    each row is an int32 array and deleted/archived rows are cleared in an
+    `alive` bitmap instead of being removed, so deleting k messages costs
+    O(k) and no index ever has to be rebuilt.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.ids: List[str] = []
+        self.subjects: List[str] = []
+        self.senders: List[str] = []
+        self.snippets: List[str] = []
+        self.row_of: Dict[str, int] = {}
+        self.internal_dates = np.zeros(capacity, dtype=np.int64)
+        self.labels = np.full(capacity, NO_CLUSTER, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self._groups: Optional[Dict[int, np.ndarray]] = None
+        self.version = next(_VERSIONS)  # changes on every write, for caches built on top of the table
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def n_alive(self) -> int:
+        return int(self.alive[:len(self.ids)].sum())
+
+    def _grow(self):
+        size = max(1024, 2 * len(self.labels))
+        for name, fill in (("internal_dates", 0), ("labels", NO_CLUSTER), ("alive", False)):
+            old = getattr(self, name)
+            new = np.full(size, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # -------------------------
+    # WRITES
+    # -------------------------
+    def append(self, mid: str, meta: Dict[str, Any]) -> int:
+        """Add a Gmail metadata message; returns its row."""
+        mid = sys.intern(mid)
+        row = self.row_of.get(mid)
+        if row is not None:
+            return row
+        headers = header_map(meta)
+        row = len(self.ids)
+        if row == len(self.labels):
+            self._grow()
+        self.ids.append(mid)
+        self.subjects.append(headers.get("subject", ""))
+        self.senders.append(sys.intern(headers.get("from", "")))
+        self.snippets.append(meta.get("snippet", ""))
+        self.internal_dates[row] = int(meta.get("internalDate") or 0)
+        self.alive[row] = True
+        self.row_of[mid] = row
+        self._groups = None
+        self.version = next(_VERSIONS)
+        return row
+
+    def set_clusters(self, mapping: Dict[int, Iterable[int]]):
+        """Assign clusters from {cluster id: rows}; rows not listed become unclustered."""
+        self.labels[:] = NO_CLUSTER
+        for cid, rows in mapping.items():
+            self.labels[np.asarray(list(rows), dtype=np.int64)] = cid
+        self._groups = None
+        self.version = next(_VERSIONS)
+
+    def remove(self, mids: Iterable[str]) -> List[str]:
+        """Tombstone deleted or archived messages; returns the ids that were present."""
+        removed = []
+        for mid in mids:
+            row = self.row_of.get(mid)
+            if row is not None and self.alive[row]:
+                self.alive[row] = False
+                removed.append(mid)
+        if removed:
+            self._groups = None
+            self.version = next(_VERSIONS)
+        return removed
+
+    # -------------------------
+    # READS
+    # -------------------------
+    def rows(self, mids: Iterable[str]) -> np.ndarray:
+        return np.asarray([self.row_of[m] for m in mids if m in self.row_of], dtype=np.int64)
+
+    def clusters(self) -> Dict[int, np.ndarray]:
+        """{cluster id: live rows in insertion order}, cached until the table changes."""
+        if self._groups is None:
+            n = len(self.ids)
+            self._groups = self.group_rows(np.flatnonzero(self.alive[:n]))
+        return self._groups
+
+    def group_rows(self, rows: np.ndarray) -> Dict[int, np.ndarray]:
+        """{cluster id: the given rows in that cluster}, unclustered rows left out."""
+        rows = rows[self.labels[rows] != NO_CLUSTER]
+        labels = self.labels[rows]
+        order = np.argsort(labels, kind="stable")
+        cids, starts = np.unique(labels[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        return {int(c): rows[order[s:e]] for c, s, e in zip(cids, starts, bounds)}
+
+    def text(self, row: int) -> str:
+        """The short text a message is clustered on: subject + snippet."""
+        return f"Subject: {self.subjects[row]}\n{self.snippets[row]}"
+
+    def cluster_order(self, groups: Optional[Dict[int, np.ndarray]] = None) -> List[int]:
+        """Cluster ids, largest first (ties by id)."""
+        groups = self.clusters() if groups is None else groups
+        return sorted(groups, key=lambda cid: (-len(groups[cid]), cid))
+
+    def meta(self, mid: str) -> Dict[str, Any]:
+        """The display fields of one message as a dict (empty when unknown)."""
+        row = self.row_of.get(mid)
+        if row is None:
+            return {}
+        return {
+            "subject": self.subjects[row],
+            "from": self.senders[row],
+            "snippet": self.snippets[row],
+            "internal_date": int(self.internal_dates[row]),
+        }
@@ -0,0 +1,144 @@
+# metrics.py
+import functools
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict
+
+# Off unless MAILORG_METRICS=1 or enable() is called. When off, span() hands back
+# a shared no-op context manager and incr() returns immediately.
+_enabled = os.getenv("MAILORG_METRICS", "") not in ("", "0")
+_lock = threading.Lock()
+_spans: Dict[str, list] = {}      # name -> [count, total_seconds, max_seconds]
+_counters: Dict[str, float] = {}  # name -> value
+
+
+def enable(on: bool = True):
+    global _enabled
+    _enabled = on
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            rec = _spans.setdefault(self.name, [0, 0.0, 0.0])
+            rec[0] += 1
+            rec[1] += elapsed
+            rec[2] = max(rec[2], elapsed)
+        return False
+
+
+def span(name: str):
+    """Time a block: `with metrics.span("gmail.metadata"): ...`"""
+    return _Span(name) if _enabled else _NOOP
+
+
+def timed(name: str):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name: str, value: float = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def add_json_bytes(name: str, payload: Any):
+    """Count the serialized size of an API payload (only computed when enabled)."""
+    if _enabled and payload:
+        incr(name, len(payload) if isinstance(payload, (str, bytes)) else len(json.dumps(payload)))
+
+
+# -----------------------------
+# EXPORT
+# -----------------------------
+def snapshot() -> Dict[str, Any]:
+    """Everything recorded so far, plus hit rates for every *.hits / *.misses pair."""
+    with _lock:
+        spans = {
+            name: {"count": c, "total_seconds": round(t, 6), "max_seconds": round(m, 6)}
+            for name, (c, t, m) in _spans.items()
+        }
+        counters = dict(_counters)
+    hit_rates = {}
+    for name, hits in counters.items():
+        if name.endswith(".hits"):
+            prefix = name[:-len(".hits")]
+            total = hits + counters.get(prefix + ".misses", 0)
+            if total:
+                hit_rates[prefix] = round(hits / total, 4)
+    return {"enabled": _enabled, "spans": spans, "counters": counters, "hit_rates": hit_rates}
+
+
+def to_json(indent: int = 2) -> str:
+    return json.dumps(snapshot(), indent=indent, sort_keys=True)
+
+
+def _prom_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def to_prometheus() -> str:
+    """Prometheus text exposition format."""
+    snap = snapshot()
+    lines = [
+        "# TYPE mailorg_span_seconds_total counter",
+        "# TYPE mailorg_span_count counter",
+        "# TYPE mailorg_span_max_seconds gauge",
+    ]
+    for name, s in sorted(snap["spans"].items()):
+        lines.append(f'mailorg_span_seconds_total{{stage="{name}"}} {s["total_seconds"]}')
+        lines.append(f'mailorg_span_count{{stage="{name}"}} {s["count"]}')
+        lines.append(f'mailorg_span_max_seconds{{stage="{name}"}} {s["max_seconds"]}')
+    for name, value in sorted(snap["counters"].items()):
+        metric = f"mailorg_{_prom_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    for name, rate in sorted(snap["hit_rates"].items()):
+        metric = f"mailorg_{_prom_name(name)}_hit_rate"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {rate}")
+    return "\n".join(lines) + "\n"
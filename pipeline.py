@@ -0,0 +1,416 @@
+# pipeline.py
+"""
+Headless version of the app's scan for scheduled bulk runs:
+
+    python pipeline.py --query "older_than:1y" --max-results 100000
+    python pipeline.py --action archive --label-regex "newsletter|promo" --yes
+
+list -> metadata -> text -> embed -> cluster -> label -> optional action.
+The first four stages are generators joined by bounded queues (utils.prefetch),
+so only a few batches are in memory at any time whatever the mailbox size.
+Clustering is incremental (ClusterModel), so it needs no full embedding matrix.
+Bulk and list mail is grouped by stream (streams.py) and mostly never embedded.
+Progress is checkpointed to SQLite every SAVE_EVERY batches; running the same command
+again resumes where an interrupted run stopped.
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from claude_client import LabelCache, label_clusters
+from clustering import CLUSTER_MODEL_PATH, LABEL_CANDIDATES, ClusterModel, Clusterer
+from gmail_client import GmailClient
+from mailbox_store import MailboxStore
+from prefilter import header_map
+from streams import STREAM_SAMPLE, stream_key
+from text_cache import Prefetcher, TextCache
+from utils import chunks, evenly_spaced, prefetch
+
+CHECKPOINT_PATH = "pipeline_checkpoint.db"
+BATCH_SIZE = 500          # messages per pipeline batch
+QUEUE_DEPTH = 2           # batches buffered between two stages
+SEED_SIZE = 5000          # messages clustered from scratch before switching to incremental assignment
+LABEL_CHUNK = 50          # clusters labeled at a time
+SAVE_EVERY = 10           # batches (or label chunks) between two writes of the model file
+BODY_CHARS = 2000         # body text kept per message with --bodies
+
+
+def cluster_text(meta: Dict[str, Any], body: Optional[str] = None) -> str:
+    """Text a message is clustered on: subject plus snippet (or body), as in the app."""
+    subject = header_map(meta).get("subject", "")
+    return f"Subject: {subject}\n{body if body is not None else meta.get('snippet', '')}"
+
+
+class Checkpoint:
+    """Progress of one pipeline run: the listed ids, which of them are clustered, and finished actions."""
+
+    def __init__(self, path: str = CHECKPOINT_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, done INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS actions (cluster TEXT PRIMARY KEY, action TEXT, count INTEGER);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state(key, value) VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def reset(self):
+        with self._lock:
+            self._conn.executescript("DELETE FROM ids; DELETE FROM actions; DELETE FROM state;")
+            self._conn.commit()
+
+    def clear_actions(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM actions")
+            self._conn.commit()
+
+    def add_ids(self, message_ids: Iterable[str]):
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO ids(id) VALUES (?)", ((mid,) for mid in message_ids))
+            self._conn.commit()
+
+    def pending(self, batch_size: int = BATCH_SIZE) -> Iterator[List[str]]:
+        """Listed ids not clustered yet, in listing order, batch_size at a time."""
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, id FROM ids WHERE done=0 AND rowid>? ORDER BY rowid LIMIT ?", (last, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [mid for _, mid in rows]
+
+    def mark_done(self, message_ids: Iterable[str]):
+        with self._lock:
+            self._conn.executemany("UPDATE ids SET done=1 WHERE id=?", ((mid,) for mid in message_ids))
+            self._conn.commit()
+
+    def in_run(self, message_ids: List[str]) -> List[str]:
+        """The subset of message_ids that belongs to this run."""
+        out = []
+        for part in chunks(message_ids, 500):
+            with self._lock:
+                found = {r[0] for r in self._conn.execute(
+                    f"SELECT id FROM ids WHERE id IN ({','.join('?' * len(part))})", part
+                )}
+            out.extend(mid for mid in part if mid in found)
+        return out
+
+    def counts(self) -> Tuple[int, int]:
+        """(listed, clustered)"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*), COALESCE(SUM(done), 0) FROM ids").fetchone()
+
+    def action_done(self, cid: int) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM actions WHERE cluster=?", (str(cid),)).fetchone() is not None
+
+    def record_action(self, cid: int, action: str, count: int):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO actions(cluster, action, count) VALUES (?, ?, ?)", (str(cid), action, count))
+            self._conn.commit()
+
+
+# -----------------------------
+# STREAMING STAGES
+# -----------------------------
+def meta_stage(gmail: GmailClient, batches: Iterable[List[str]]) -> Iterator[Tuple[List[str], List[Dict[str, Any]]]]:
+    for ids in batches:
+        metas = gmail.get_messages_meta(ids)
+        found = [mid for mid in ids if mid in metas]
+        yield found, [metas[mid] for mid in found]
+
+
+def text_stage(batches, prefetcher: Optional[Prefetcher],
+               body_chars: Optional[int] = BODY_CHARS) -> Iterator[Tuple[List[str], List[str], List[Optional[str]]]]:
+    for ids, metas in batches:
+        keys = [stream_key(m) for m in metas]
+        if prefetcher is None:
+            yield ids, [cluster_text(m) for m in metas], keys
+            continue
+        prefetcher.warm(ids)
+        bodies = [prefetcher.try_get_text(mid) for mid in ids]
+        # a body that can't be fetched falls back to the snippet
+        yield ids, [cluster_text(m, body[:body_chars] if body is not None else None) for m, body in zip(metas, bodies)], keys
+
+
+def embed_stage(clusterer: Clusterer, batches, known_streams: Dict[str, int], full_bodies: bool = False):
+    """Embed each batch, except mail of a stream in known_streams and all but the first
+    STREAM_SAMPLE messages per stream in the batch; their rows are left NaN.
+    With full_bodies, texts are whole bodies and go through Clusterer.embed_bodies."""
+    for ids, texts, keys in batches:
+        seen: Dict[str, int] = {}
+        rows = []
+        for i, key in enumerate(keys):
+            if key:
+                seen[key] = seen.get(key, 0) + 1
+                if key in known_streams or seen[key] > STREAM_SAMPLE:
+                    continue
+            rows.append(i)
+        emb = None
+        if rows and full_bodies:
+            emb = np.full((len(texts), clusterer.model.get_sentence_embedding_dimension()), np.nan, dtype=np.float32)
+            clusterer.embed_bodies(((i, texts[i]) for i in rows), emb)
+        elif rows:
+            vectors = clusterer.embed_texts([texts[i] for i in rows])
+            emb = np.full((len(texts), vectors.shape[1]), np.nan, dtype=np.float32)
+            emb[rows] = vectors
+        yield ids, texts, keys, emb
+
+
+def stream(gmail: GmailClient, clusterer: Clusterer, ckpt: Checkpoint, prefetcher: Optional[Prefetcher],
+           batch_size: int = BATCH_SIZE, depth: int = QUEUE_DEPTH, known_streams: Optional[Dict[str, int]] = None,
+           full_bodies: bool = False):
+    """(ids, texts, stream keys, embeddings) for every pending batch, with all stages running concurrently.
+    full_bodies embeds whole bodies (chunked and pooled) instead of their first BODY_CHARS."""
+    batches = prefetch(meta_stage(gmail, ckpt.pending(batch_size)), depth)
+    batches = prefetch(text_stage(batches, prefetcher, None if full_bodies else BODY_CHARS), depth)
+    return prefetch(embed_stage(clusterer, batches, known_streams or {}, full_bodies), depth)
+
+
+# -----------------------------
+# RUN
+# -----------------------------
+def list_stage(gmail: GmailClient, ckpt: Checkpoint, query: str, max_results: int):
+    """Resume an interrupted run, or list the mailbox again once the previous run finished
+    (already clustered ids keep their checkpoint, so only new mail is processed)."""
+    run_key = json.dumps({"query": query, "max_results": max_results})
+    if ckpt.get("run") != run_key:
+        if ckpt.get("run") is not None:
+            print("Checkpoint belongs to a different query, starting over")
+        ckpt.reset()
+        ckpt.set("run", run_key)
+    listed, done = ckpt.counts()
+    if ckpt.get("listed") != "1" or listed == done:
+        with metrics.span("pipeline.list"):
+            ids = gmail.list_message_ids(query=query, max_results=max_results)
+        ckpt.add_ids(ids)
+        ckpt.clear_actions()
+        ckpt.set("listed", "1")
+        listed, done = ckpt.counts()
+    print(f"{listed} messages listed, {done} already clustered")
+
+
+def cluster_stage(clusterer: Clusterer, ckpt: Checkpoint, batches, model: Optional[ClusterModel],
+                  model_path: str, seed_size: int = SEED_SIZE) -> Optional[ClusterModel]:
+    """Fit a model on the first seed_size messages (unless one exists), then assign the rest batch by batch.
+    The model is written every SAVE_EVERY batches and when the stage ends or fails; ids are
+    checkpointed as done only once a saved model holds them."""
+    seed: List[tuple] = []
+    seeded = 0
+    unsaved: List[str] = []  # ids assigned since the last save
+    batches_since_save = 0
+
+    def save():
+        nonlocal batches_since_save
+        if model is not None and unsaved:
+            model.save(model_path)
+            ckpt.mark_done(unsaved)
+            unsaved.clear()
+        batches_since_save = 0
+
+    def commit(ids: List[str]):
+        nonlocal batches_since_save
+        unsaved.extend(ids)
+        batches_since_save += 1
+        if batches_since_save >= SAVE_EVERY:
+            save()
+
+    try:
+        for ids, texts, keys, emb in batches:
+            if model is None:
+                seed.append((ids, texts, keys, emb))
+                seeded += len(ids)
+                if seeded < seed_size:
+                    continue
+                model = fit_seed(clusterer, seed)
+                commit([mid for part in seed for mid in part[0]])
+                save()
+                seed = []
+            else:
+                # ids can already be members if a previous run stopped between save and mark_done
+                keep = [i for i, mid in enumerate(ids) if model.cluster_of(mid) is None]
+                if keep:
+                    clusterer.assign_new(model, [texts[i] for i in keep], [ids[i] for i in keep],
+                                         emb=emb[keep] if emb is not None else None, keys=[keys[i] for i in keep])
+                commit(ids)
+            listed, done = ckpt.counts()
+            print(f"clustered {done + len(unsaved)}/{listed} messages into {len(model.cluster_ids)} clusters")
+        if seed:
+            model = fit_seed(clusterer, seed)
+            commit([mid for part in seed for mid in part[0]])
+    finally:
+        save()
+    return model
+
+
+def fit_seed(clusterer: Clusterer, seed) -> ClusterModel:
+    ids = [mid for part in seed for mid in part[0]]
+    texts = [t for part in seed for t in part[1]]
+    keys = [k for part in seed for k in part[2]]
+    dim = next((part[3].shape[1] for part in seed if part[3] is not None), None)
+    emb = None
+    if dim is not None:
+        emb = np.concatenate([part[3] if part[3] is not None else np.full((len(part[0]), dim), np.nan, dtype=np.float32)
+                              for part in seed])
+    with metrics.span("pipeline.seed"):
+        clusters, streams = clusterer.cluster_streams(texts, keys, emb=emb)
+    return clusterer.fit_model(texts, ids, clusters, emb=emb, streams=streams)
+
+
+def label_stage(gmail: GmailClient, clusterer: Clusterer, model: ClusterModel, model_path: str,
+                prefetcher: Optional[Prefetcher]):
+    """Label every cluster that has no label yet from a few representative members,
+    saving the model every SAVE_EVERY chunks and at the end."""
+    unlabeled = [cid for cid in model.cluster_ids if str(cid) not in model.labels and model.members.get(cid)]
+    if unlabeled:
+        print(f"labeling {len(unlabeled)} clusters")
+    try:
+        for n, part in enumerate(chunks(unlabeled, LABEL_CHUNK), start=1):
+            label_chunk(gmail, clusterer, model, part, prefetcher)
+            if n % SAVE_EVERY == 0:
+                model.save(model_path)
+    finally:
+        if unlabeled:
+            model.save(model_path)
+
+
+def label_chunk(gmail: GmailClient, clusterer: Clusterer, model: ClusterModel, part: List[int],
+                prefetcher: Optional[Prefetcher]):
+    """Label one chunk of clusters into model.labels (failed labels are left out)."""
+    candidates = {cid: evenly_spaced(model.members[cid], LABEL_CANDIDATES) for cid in part}
+    metas = gmail.get_messages_meta([mid for ids in candidates.values() for mid in ids])
+    samples = {}
+    for cid, ids in candidates.items():
+        ids = [mid for mid in ids if mid in metas]
+        if not ids:
+            continue
+        # chosen on metadata text, so bodies are only fetched for the chosen few
+        ids = [ids[i] for i in clusterer.representatives([cluster_text(metas[mid]) for mid in ids])]
+        if prefetcher is None:
+            samples[cid] = [cluster_text(metas[mid]) for mid in ids]
+        else:
+            bodies = [prefetcher.try_get_text(mid) for mid in ids]
+            samples[cid] = [cluster_text(metas[mid], body[:BODY_CHARS] if body is not None else None)
+                            for mid, body in zip(ids, bodies)]
+    labels = label_clusters(samples, cache=LabelCache())
+    failed = sum(1 for lab in labels.values() if lab.get("failed"))
+    if failed:
+        print(f"{failed} clusters could not be labeled, they are retried on the next run")
+    model.labels.update({str(cid): lab for cid, lab in labels.items() if not lab.get("failed")})
+
+
+def action_stage(gmail: GmailClient, model: ClusterModel, model_path: str, ckpt: Checkpoint,
+                 action: str, label_regex: str, apply: bool, text_cache: Optional[TextCache] = None):
+    """Trash or archive this run's messages in every cluster whose label matches label_regex."""
+    pattern = re.compile(label_regex, re.I)
+    run = gmail.bulk_trash if action == "trash" else gmail.bulk_archive
+    total = 0
+    for cid in list(model.cluster_ids):
+        label = model.labels.get(str(cid), {}).get("label", "")
+        if not pattern.search(label) or ckpt.action_done(cid):
+            continue
+        ids = ckpt.in_run(model.members.get(cid, []))
+        if not ids:
+            continue
+        if not apply:
+            print(f"would {action} {len(ids):>6} messages in cluster {cid}: {label}")
+            total += len(ids)
+            continue
+        done, failed = run(ids)
+        if failed:
+            print(f"could not {action} {len(failed)} messages in cluster {cid}")
+        print(f"{action}d {len(done):>6} messages in cluster {cid}: {label}")
+        model.discard(done)
+        model.save(model_path)
+        if text_cache is not None:
+            text_cache.discard(done)
+        ckpt.record_action(cid, action, len(done))
+        total += len(done)
+    if not apply:
+        print(f"dry run: {total} messages would be {action}d; pass --yes to apply")
+
+
+def summarize(model: ClusterModel, top: int = 20):
+    sizes = sorted(((len(m), cid) for cid, m in model.members.items() if m), reverse=True)
+    print(f"\n{len(sizes)} clusters; largest:")
+    for size, cid in sizes[:top]:
+        print(f"  {size:>7}  {model.labels.get(str(cid), {}).get('label', f'Cluster {cid}')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cluster, label and optionally clean up a mailbox without the UI.")
+    parser.add_argument("--query", default="", help="Gmail search query (default: all mail)")
+    parser.add_argument("--max-results", type=int, default=100000)
+    parser.add_argument("--bodies", action="store_true", help="cluster on message bodies instead of snippets (much slower)")
+    parser.add_argument("--full-bodies", action="store_true",
+                        help="like --bodies, but embed whole bodies in model-sized chunks instead of their start (slowest)")
+    parser.add_argument("--recluster", action="store_true", help="ignore the saved cluster model and checkpoint")
+    parser.add_argument("--no-label", action="store_true", help="skip Claude labeling")
+    parser.add_argument("--action", choices=["trash", "archive"], help="apply to clusters whose label matches --label-regex")
+    parser.add_argument("--label-regex", help="case-insensitive regex matched against cluster labels")
+    parser.add_argument("--yes", action="store_true", help="actually perform --action (default is a dry run)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--model", default=CLUSTER_MODEL_PATH)
+    parser.add_argument("--metrics", help="write timing and API metrics as JSON to this file")
+    args = parser.parse_args(argv)
+    if args.action and not args.label_regex:
+        parser.error("--action needs --label-regex")
+    if args.action and args.no_label:
+        parser.error("--action matches on labels, so it can't be combined with --no-label")
+    if args.metrics:
+        metrics.enable()
+
+    gmail = GmailClient(store=MailboxStore())
+    clusterer = Clusterer()
+    clusterer.warm()  # model loads while the mailbox is being listed
+    ckpt = Checkpoint(args.checkpoint)
+    if args.recluster:
+        ckpt.reset()
+    text_cache = TextCache() if args.bodies or args.full_bodies else None
+    prefetcher = Prefetcher(gmail, text_cache) if text_cache is not None else None
+
+    list_stage(gmail, ckpt, args.query, args.max_results)
+    model = None if args.recluster and ckpt.counts()[1] == 0 else ClusterModel.load(args.model)
+    known_streams = model.streams if model is not None else None
+    with metrics.span("pipeline.cluster"):
+        batches = stream(gmail, clusterer, ckpt, prefetcher, args.batch_size, known_streams=known_streams,
+                         full_bodies=args.full_bodies)
+        model = cluster_stage(clusterer, ckpt, batches, model, args.model)
+    if model is None:
+        print("Nothing to cluster.")
+        return 0
+    if not args.no_label:
+        label_stage(gmail, clusterer, model, args.model, prefetcher)
+    if args.action:
+        action_stage(gmail, model, args.model, ckpt, args.action, args.label_regex, args.yes, text_cache)
+    summarize(model)
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.to_json())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
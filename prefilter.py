@@ -0,0 +1,61 @@
+# prefilter.py
+import re
+from typing import Any, Dict, Optional
+
+# Cheap header/label rules that settle obvious safe-delete cases without calling Claude.
+NOREPLY_RE = re.compile(r"(no-?reply|do-?not-?reply|notifications?|newsletters?|marketing|promo(tions)?|mailer)@", re.I)
+BULK_TEXT_RE = re.compile(r"\b(unsubscribe|view (this|it) in (your|a) browser|newsletter|% off|sale ends|limited time|webinar)\b", re.I)
+KEEP_TEXT_RE = re.compile(
+    r"\b(invoice|receipt|order (number|#)|password|verification code|security alert|contract|"
+    r"tax|statement|itinerary|booking|reservation|appointment|offer letter|interview)\b",
+    re.I
+)
+KEEP_LABELS = {"STARRED", "IMPORTANT", "SENT", "DRAFT"}
+BULK_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_FORUMS"}
+
+SAFE_SCORE = 0.9
+KEEP_SCORE = 0.1
+
+
+def header_map(meta: Dict[str, Any]) -> Dict[str, str]:
+    """Gmail metadata headers as {name: value}, names lower-cased."""
+    return {h["name"].lower(): h["value"] for h in meta.get("payload", {}).get("headers", [])}
+
+
+def meta_text(meta: Dict[str, Any]) -> str:
+    """Short text used when a message is scored from metadata alone."""
+    headers = header_map(meta)
+    return f"From: {headers.get('from', '')}\nSubject: {headers.get('subject', '')}\n{meta.get('snippet', '')}"
+
+
+def prescore(meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Score a message from its metadata when the answer is obvious.
+    Returns {"score", "reason", "source": "local"} or None if Claude should decide.
+    """
+    labels = set(meta.get("labelIds", []))
+    headers = header_map(meta)
+    text = f"{headers.get('subject', '')} {meta.get('snippet', '')}"
+
+    kept = labels & KEEP_LABELS
+    if kept:
+        return {"score": KEEP_SCORE, "reason": f"Marked {', '.join(sorted(kept)).lower()}.", "source": "local"}
+    if KEEP_TEXT_RE.search(text):
+        # could be transactional; let Claude look at it
+        return None
+
+    signals = []
+    if "list-unsubscribe" in headers or "list-id" in headers:
+        signals.append("mailing list headers")
+    if headers.get("precedence", "").lower() in ("bulk", "list", "junk"):
+        signals.append("bulk precedence")
+    if NOREPLY_RE.search(headers.get("from", "")):
+        signals.append("no-reply sender")
+    if labels & BULK_LABELS:
+        signals.append("promotions/social category")
+    if BULK_TEXT_RE.search(text):
+        signals.append("newsletter wording")
+
+    if len(signals) >= 2:
+        return {"score": SAFE_SCORE, "reason": f"Bulk mail: {', '.join(signals)}.", "source": "local"}
+    return None
@@ -1,44 +1,196 @@
 # processor.py
 from email import message_from_bytes
-from email.policy import default
+from email.message import Message
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from html.parser import HTMLParser
 import base64
-from typing import Tuple, Optional
+import binascii
+import codecs
+from typing import Iterable, List, Optional
 import quopri
 import re
 
-def extract_plaintext_from_raw(raw_b64: str) -> str:
-    """Accepts raw base64url string as returned by Gmail API 'raw' field; returns plaintext."""
+import metrics
+
+DEFAULT_MAX_CHARS = 20000  # text budget per message for batch extraction
+DECODE_CHUNK = 64 * 1024   # encoded characters decoded per step
+
+CRLF_RE = re.compile(r'\r\n?')
+BLANK_LINES_RE = re.compile(r'\n\s*\n\s*(\n\s*)+')
+SPACES_RE = re.compile(r'[ \t\xa0\u200c]+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+class _Full(Exception):
+    """Raised internally once the text budget is used up."""
+
+
+class _TextSink:
+    def __init__(self, max_chars: Optional[int]):
+        self.max_chars = max_chars
+        self.parts: List[str] = []
+        self.size = 0
+
+    @property
+    def full(self) -> bool:
+        return self.max_chars is not None and self.size >= self.max_chars
+
+    def add(self, text: str):
+        if self.max_chars is not None:
+            text = text[:self.max_chars - self.size]
+        self.parts.append(text)
+        self.size += len(text)
+        if self.full:
+            raise _Full
+
+
+class _HTMLText(HTMLParser):
+    """Collects visible text from HTML, skipping script/style and breaking lines at block tags."""
+
+    SKIP = {"script", "style", "head", "noscript", "template"}
+    BLOCK = {"p", "div", "br", "tr", "li", "ul", "ol", "table", "section", "article",
+             "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "hr"}
+
+    def __init__(self, sink: _TextSink):
+        super().__init__(convert_charrefs=True)
+        self.sink = sink
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip_depth += 1
+        elif tag in self.BLOCK:
+            self.sink.add("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self.BLOCK:
+            self.sink.add("\n")
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+        data = SPACES_RE.sub(" ", data)
+        if data.strip():
+            self.sink.add(data)
+
+
+def _to_bytes(text: str) -> bytes:
+    # the bytes parser keeps non-ASCII bytes as surrogate escapes; this recovers them
+    try:
+        return text.encode("ascii", errors="surrogateescape")
+    except UnicodeEncodeError:
+        return text.encode("utf-8", errors="replace")
+
+
+def _iter_decoded(part: Message):
+    """Yield the part's body as bytes, DECODE_CHUNK at a time, so long bodies
+    can be abandoned once enough text has been collected."""
+    payload = part.get_payload(decode=False)
+    if not isinstance(payload, str):
+        return
+    cte = str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+    if cte == "base64":
+        encoded = WHITESPACE_RE.sub("", payload)
+        step = DECODE_CHUNK - DECODE_CHUNK % 4
+        for i in range(0, len(encoded), step):
+            piece = encoded[i:i + step]
+            piece += "=" * (-len(piece) % 4)
+            try:
+                yield base64.b64decode(piece)
+            except binascii.Error:
+                return
+    elif cte == "quoted-printable":
+        start = 0
+        while start < len(payload):
+            # cut on a line break so no =XX escape is split
+            end = payload.find("\n", start + DECODE_CHUNK)
+            end = len(payload) if end == -1 else end + 1
+            yield quopri.decodestring(_to_bytes(payload[start:end]))
+            start = end
+    else:
+        for i in range(0, len(payload), DECODE_CHUNK):
+            yield _to_bytes(payload[i:i + DECODE_CHUNK])
+
+
+def _decoder(part: Message):
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+def _collect(m: Message, sink: _TextSink):
+    if m.is_multipart():
+        subparts = m.get_payload()
+        if m.get_content_type() == "multipart/alternative":
+            # the plain alternative carries the same text without markup
+            plain = [p for p in subparts if p.get_content_type() == "text/plain"]
+            subparts = plain or subparts
+        for part in subparts:
+            _collect(part, sink)
+        return
+
+    ctype = m.get_content_type()
+    # attachments and non-text parts are never decoded
+    if m.get_content_disposition() == "attachment" or ctype not in ("text/plain", "text/html"):
+        return
+
+    decoder = _decoder(m)
+    if sink.parts:
+        sink.add("\n")
+    if ctype == "text/plain":
+        for chunk in _iter_decoded(m):
+            sink.add(decoder.decode(chunk))
+        sink.add(decoder.decode(b"", final=True))
+    else:
+        parser = _HTMLText(sink)
+        for chunk in _iter_decoded(m):
+            parser.feed(decoder.decode(chunk))
+        parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+
+
+@metrics.timed("extract")
+def extract_plaintext_from_raw(raw_b64: str, max_chars: Optional[int] = None) -> str:
+    """Accepts raw base64url string as returned by Gmail API 'raw' field; returns plaintext.
+    Stops reading body parts once max_chars characters of text have been collected."""
+    metrics.incr("extract.raw_bytes", len(raw_b64))
+    raw_b64 += "=" * (-len(raw_b64) % 4)
     raw_bytes = base64.urlsafe_b64decode(raw_b64.encode("utf-8"))
-    msg = message_from_bytes(raw_bytes, policy=default)
-    text_parts = []
-
-    def walk_parts(m):
-        if m.is_multipart():
-            for part in m.iter_parts():
-                walk_parts(part)
-        else:
-            ctype = m.get_content_type()
-            disp = m.get_content_disposition()
-            if ctype == "text/plain" and disp != "attachment":
-                payload = m.get_payload(decode=True)
-                if payload:
-                    charset = m.get_content_charset() or "utf-8"
-                    try:
-                        text_parts.append(payload.decode(charset, errors="replace"))
-                    except Exception:
-                        text_parts.append(payload.decode("utf-8", errors="replace"))
-            elif ctype == "text/html":
-                payload = m.get_payload(decode=True)
-                if payload:
-                    charset = m.get_content_charset() or "utf-8"
-                    html = payload.decode(charset, errors="replace")
-                    # crude html -> text
-                    text = re.sub('<[^<]+?>', ' ', html)
-                    text_parts.append(text)
-
-    walk_parts(msg)
-    joined = "\n".join(text_parts)
+    msg = message_from_bytes(raw_bytes)
+    sink = _TextSink(max_chars)
+    try:
+        _collect(msg, sink)
+    except _Full:
+        pass
+
+    joined = "".join(sink.parts)
     # minimal cleanup
-    joined = re.sub(r'\r\n', '\n', joined)
-    joined = re.sub(r'\n{2,}', '\n\n', joined)
+    joined = CRLF_RE.sub('\n', joined)
+    joined = BLANK_LINES_RE.sub('\n\n', joined)
     return joined.strip()
+
+
+def _extract_safe(raw_b64: str, max_chars: Optional[int]) -> str:
+    try:
+        return extract_plaintext_from_raw(raw_b64, max_chars) if raw_b64 else ""
+    except Exception:
+        return ""
+
+
+@metrics.timed("extract.batch")
+def extract_plaintext_batch(
+    raws: Iterable[str],
+    max_chars: Optional[int] = DEFAULT_MAX_CHARS,
+    max_workers: Optional[int] = None,
+    chunksize: int = 16
+) -> List[str]:
+    """Extract plaintext for many raw messages on a process pool (one worker per core by default).
+    Output order matches input; messages that fail to parse give ''.
+    Metrics recorded inside worker processes are not collected, only the batch span."""
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(partial(_extract_safe, max_chars=max_chars), raws, chunksize=chunksize))
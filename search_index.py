@@ -0,0 +1,173 @@
+# search_index.py
+import re
+from bisect import bisect_left
+from datetime import datetime, timezone
+from email.utils import parseaddr
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from message_table import NO_CLUSTER, MessageTable
+
+_TOKEN = re.compile(r"[^\W_]+")
+_FACET = re.compile(r"^(from|cluster|after|before):(.+)$")
+BODY_CHARS = 20_000  # body text indexed per message
+
+
+def tokens(text: str) -> set:
+    return {t for t in _TOKEN.findall(text.lower()) if len(t) > 1 or t.isdigit()}
+
+
+def sender_domain(sender: str) -> str:
+    address = parseaddr(sender)[1].lower()
+    return address.rsplit("@", 1)[-1] if "@" in address else ""
+
+
+def _day_ms(value: str) -> int:
+    """YYYY-MM-DD (or YYYY-MM, YYYY) as epoch milliseconds, UTC."""
+    parts = [int(p) for p in value.split("-")] + [1, 1]
+    return int(datetime(parts[0], parts[1], parts[2], tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class SearchIndex:
+    """
+    Inverted index over the rows of a MessageTable, for filtering fetched
+    messages without another Gmail query.
+
+    Words of the subject, sender and snippet are indexed by sync() as rows are
+    appended; body text is added with add_body() whenever a body is at hand
+    (text cache, preview). Each row's sender domain is kept as an int column, and
+    dates, clusters and deletions are read from the table's own arrays, so a
+    delete or archive (a tombstone in the table) is reflected immediately.
+
+    Query syntax: words (all must match, `word*` for a prefix) plus the facets
+    from:<domain>, cluster:<id>, after:<YYYY-MM-DD> and before:<YYYY-MM-DD>.
+    """
+
+    def __init__(self, table: MessageTable):
+        self.table = table
+        self._postings: Dict[str, List[int]] = {}
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._vocab: Optional[List[str]] = None
+        self.domains: List[str] = []
+        self._domain_id: Dict[str, int] = {}
+        self._sender: Dict[str, Tuple[int, set]] = {}  # sender -> (domain id, tokens); senders repeat a lot
+        self.domain_of = np.zeros(0, dtype=np.int32)
+        self._with_body: set = set()
+        self._indexed = 0
+
+    def _add_tokens(self, row: int, words: Iterable[str]):
+        for word in words:
+            rows = self._postings.get(word)
+            if rows is None:
+                self._postings[word] = [row]
+                self._vocab = None
+            else:
+                rows.append(row)
+                self._arrays.pop(word, None)
+
+    # -------------------------
+    # UPDATES
+    # -------------------------
+    def sync(self):
+        """Index the metadata of rows appended to the table since the last call."""
+        table = self.table
+        n = len(table)
+        if n == self._indexed:
+            return
+        domain_of = np.zeros(n, dtype=np.int32)
+        domain_of[:self._indexed] = self.domain_of
+        for row in range(self._indexed, n):
+            sender = table.senders[row]
+            known = self._sender.get(sender)
+            if known is None:
+                domain = sender_domain(sender)
+                did = self._domain_id.get(domain)
+                if did is None:
+                    did = self._domain_id[domain] = len(self.domains)
+                    self.domains.append(domain)
+                known = self._sender[sender] = (did, tokens(sender))
+            domain_of[row] = known[0]
+            self._add_tokens(row, tokens(f"{table.subjects[row]} {table.snippets[row]}") | known[1])
+        self.domain_of = domain_of
+        self._indexed = n
+
+    def add_body(self, mid: str, text: str):
+        """Index a message's extracted body text (once per message)."""
+        row = self.table.row_of.get(mid)
+        if row is None or row in self._with_body or not text:
+            return
+        self._with_body.add(row)
+        self._add_tokens(row, tokens(text[:BODY_CHARS]))
+
+    def add_bodies(self, texts: Dict[str, str]):
+        for mid, text in texts.items():
+            self.add_body(mid, text)
+
+    # -------------------------
+    # QUERIES
+    # -------------------------
+    def _rows(self, word: str) -> np.ndarray:
+        rows = self._arrays.get(word)
+        if rows is None:
+            rows = self._arrays[word] = np.asarray(self._postings.get(word, ()), dtype=np.int64)
+        return rows
+
+    def _prefix_rows(self, prefix: str) -> np.ndarray:
+        if self._vocab is None:
+            self._vocab = sorted(self._postings)
+        i = bisect_left(self._vocab, prefix)
+        parts = []
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            parts.append(self._rows(self._vocab[i]))
+            i += 1
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    @metrics.timed("search.query")
+    def search(self, query: str) -> np.ndarray:
+        """Live rows matching query, in row order."""
+        self.sync()
+        table = self.table
+        n = len(table)
+        mask = table.alive[:n].copy()
+        for term in query.split():
+            facet = _FACET.match(term.lower())
+            if facet:
+                name, value = facet.groups()
+                try:
+                    if name == "from":
+                        ids = [i for i, d in enumerate(self.domains) if d == value or d.endswith("." + value)]
+                        mask &= np.isin(self.domain_of, ids)
+                    elif name == "cluster":
+                        mask &= table.labels[:n] == int(value)
+                    elif name == "after":
+                        mask &= table.internal_dates[:n] >= _day_ms(value)
+                    else:
+                        mask &= table.internal_dates[:n] < _day_ms(value)
+                    continue
+                except ValueError:
+                    pass  # not a valid facet value: search it as words instead
+            for word in _TOKEN.findall(term.lower().rstrip("*")):
+                rows = self._prefix_rows(word) if term.endswith("*") else self._rows(word)
+                hit = np.zeros(n, dtype=bool)
+                hit[rows] = True
+                mask &= hit
+        return np.flatnonzero(mask)
+
+    def facets(self, rows: np.ndarray, top: int = 10) -> Dict[str, List[Tuple[str, int]]]:
+        """Counts of the most common sender domains, clusters and months among rows."""
+        table = self.table
+        out: Dict[str, List[Tuple[str, int]]] = {}
+        counts = np.bincount(self.domain_of[rows], minlength=len(self.domains))
+        order = np.argsort(-counts, kind="stable")[:top]
+        out["domain"] = [(self.domains[i] or "(none)", int(counts[i])) for i in order if counts[i]]
+        labels = table.labels[rows]
+        labels = labels[labels != NO_CLUSTER]
+        cids, counts = np.unique(labels, return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:top]
+        out["cluster"] = [(str(int(cids[i])), int(counts[i])) for i in order]
+        months = table.internal_dates[rows].astype("datetime64[ms]").astype("datetime64[M]")
+        values, counts = np.unique(months, return_counts=True)
+        out["month"] = [(str(v), int(c)) for v, c in zip(values[::-1][:top], counts[::-1][:top])]
+        return out
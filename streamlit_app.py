@@ -1,235 +1,382 @@
 # streamlit_app.py
 import streamlit as st
 from gmail_client import GmailClient
-from processor import extract_plaintext_from_raw
-from clustering import Clusterer
-from claude_client import summarize_cluster, safe_delete_score_for_message
-from utils import chunks
+from mailbox_store import MailboxStore
+from text_cache import TextCache, Prefetcher
+from clustering import Clusterer, ClusterModel, CLUSTER_MODEL_PATH, LABEL_CANDIDATES, body_matrix
+from streams import stream_key, STREAM_SAMPLE
+from message_table import MessageTable
+from search_index import SearchIndex
+from claude_client import safe_delete_score_for_message, label_clusters, LabelCache, score_messages
+from utils import chunks, evenly_spaced, prefetch
+import metrics
+import numpy as np
 import pandas as pd
 import threading
 import ast
+import atexit
 
 st.set_page_config(layout="wide", page_title="Email Organizer")
 
 @st.cache_resource
 def get_clients():
-    gmail = GmailClient()
+    # both are cheap to build: OAuth runs on the first Gmail call and the
+    # embedding model loads in the background while the page renders
+    gmail = GmailClient(store=MailboxStore())
     clusterer = Clusterer()
+    clusterer.warm()
     return gmail, clusterer
 
+@st.cache_resource
+def get_label_cache():
+    return LabelCache()
+
 gmail, clusterer = get_clients()
 
+@st.cache_resource
+def get_prefetcher():
+    return Prefetcher(gmail, TextCache())
+
+prefetcher = get_prefetcher()
+PREFETCH_ROWS = 10
+SCAN_PREFETCH = 3  # metadata chunks fetched ahead of the embedder during a scan
+CLUSTERS_PER_PAGE = 20
+PREVIEW_ROWS = 10
+
 st.title("Email Organizer — Prototype")
 
+@st.cache_resource
+def get_unsaved_models():
+    """Cluster models changed by deletes since they were last written: saved before
+    the next scan reads the file, after labeling, or when the server exits."""
+    unsaved = {}
+
+    def save_all():
+        for model in list(unsaved.values()):
+            model.save(CLUSTER_MODEL_PATH)
+
+    atexit.register(save_all)
+    return unsaved
+
+def save_cluster_model(model):
+    model.save(CLUSTER_MODEL_PATH)
+    get_unsaved_models().pop(id(model), None)
+
+def flush_cluster_models():
+    for model in list(get_unsaved_models().values()):
+        save_cluster_model(model)
+
 def remove_mids_from_clusters(deleted_mids):
-    clusters_state = st.session_state["clusters"]
-    mapping = clusters_state["mapping"]
-    mids = clusters_state["mids"]
-    texts = clusters_state["texts"]
-
-    # build index map
-    keep = [(i, mid) for i, mid in enumerate(mids) if mid not in deleted_mids]
-
-    if not keep:
-        st.session_state["clusters"] = {}
-        return
-
-    new_texts = []
-    new_mids = []
-    old_to_new = {}
-
-    for new_i, (old_i, mid) in enumerate(keep):
-        old_to_new[old_i] = new_i
-        new_mids.append(mid)
-        new_texts.append(texts[old_i])
-
-    new_mapping = {}
-    for cid, indices in mapping.items():
-        new_indices = [
-            old_to_new[i] for i in indices if i in old_to_new
-        ]
-        if new_indices:
-            new_mapping[cid] = new_indices
-
-    st.session_state["clusters"] = {
-        "mapping": new_mapping,
-        "texts": new_texts,
-        "mids": new_mids
-    }
-
-if "msgs_meta" not in st.session_state:
-    st.session_state["msgs_meta"] = {}
-if "clusters" not in st.session_state:
-    st.session_state["clusters"] = {}
+    prefetcher.cache.discard(deleted_mids)
+    model = st.session_state.get("cluster_model")
+    if model is not None:
+        # O(k) in memory; the npz is rewritten once later instead of on every delete
+        model.discard(deleted_mids)
+        get_unsaved_models()[id(model)] = model
+
+    # tombstones only: rows keep their numbers, so nothing is reindexed
+    st.session_state["messages"].remove(deleted_mids)
+
+if "messages" not in st.session_state:
+    st.session_state["messages"] = MessageTable()
+    st.session_state["search_index"] = SearchIndex(st.session_state["messages"])
 if "cluster_labels" not in st.session_state:
     st.session_state["cluster_labels"] = {}
 
+with st.sidebar.expander("Diagnostics", expanded=False):
+    collect = st.checkbox("Collect timing and API metrics", value=metrics.enabled(), key="metrics_enabled")
+    metrics.enable(collect)
+    snap = metrics.snapshot()
+    if snap["spans"]:
+        st.caption("Stages")
+        st.dataframe(pd.DataFrame([
+            {"stage": name, "calls": s["count"], "total s": s["total_seconds"], "max s": s["max_seconds"]}
+            for name, s in sorted(snap["spans"].items(), key=lambda x: -x[1]["total_seconds"])
+        ]), hide_index=True)
+    if snap["counters"]:
+        st.caption("Counters")
+        st.dataframe(pd.DataFrame([{"counter": k, "value": v} for k, v in sorted(snap["counters"].items())]), hide_index=True)
+    if snap["hit_rates"]:
+        st.caption("Cache hit rates")
+        st.dataframe(pd.DataFrame([{"cache": k, "hit rate": v} for k, v in sorted(snap["hit_rates"].items())]), hide_index=True)
+    st.download_button("Download JSON", metrics.to_json(), file_name="metrics.json", key="metrics_json")
+    st.download_button("Download Prometheus text", metrics.to_prometheus(), file_name="metrics.prom", key="metrics_prom")
+    if st.button("Reset metrics", key="metrics_reset"):
+        metrics.reset()
+        st.rerun()
+
 col1, col2 = st.columns([1, 3])
 with col1:
     q = st.text_input("Gmail query (leave blank for all):", value="", key="query_input")
     max_fetch = st.number_input("Max messages to fetch", min_value=100, max_value=50000, value=2000, step=100, key="max_fetch_input")
+    recluster = st.checkbox("Recluster from scratch", value=False, key="recluster_input",
+                            help="Otherwise new mail is assigned to the saved clusters and only outliers are reclustered.")
+    full_bodies = st.checkbox("Cluster on full bodies (slow)", value=False, key="full_bodies_input",
+                              help="Download every message body and embed all of it instead of subject + snippet.")
     if st.button("Scan Inbox / Archive", key="scan_button"):
         with st.spinner("Listing message IDs..."):
             ids = gmail.list_message_ids(query=q, max_results=max_fetch)
             st.session_state["message_ids"] = ids
             st.success(f"Found {len(ids)} messages.")
-        # Fetch metadata (snippets)
-        snippets = []
-        for i, mid in enumerate(st.session_state["message_ids"]):
-            if i >= 2000:
-                break
-            meta = gmail.get_message_meta(mid)
-            snippet = meta.get("snippet", "")
-            headers = {h["name"]: h["value"] for h in meta.get("payload", {}).get("headers", [])}
-            st.session_state["msgs_meta"][mid] = {
-                "snippet": snippet,
-                "subject": headers.get("Subject", ""),
-                "from": headers.get("From", ""),
-                "date": headers.get("Date", ""),
-            }
-        st.info(f"Loaded metadata for {len(st.session_state['msgs_meta'])} messages. Now clustering...")
-
-        # Prepare small sample texts for clustering: use snippet + subject
-        texts = []
-        mids = []
-        for mid, d in st.session_state["msgs_meta"].items():
-            txt = f"Subject: {d.get('subject','')}\n{d.get('snippet','')}"
-            texts.append(txt)
-            mids.append(mid)
-        # cluster
-        clusters = clusterer.hybrid_clusters(texts)
-        st.session_state["clusters"] = {"mapping": clusters, "texts": texts, "mids": mids}
+        # Fetch metadata (snippets) and embed it as it arrives: a background thread keeps up to
+        # SCAN_PREFETCH chunks ahead while this thread encodes, so download and inference overlap.
+        # Cached messages come straight from the local store.
+        # Bulk/list mail is grouped by its stream key instead: only the first STREAM_SAMPLE
+        # messages of a stream are embedded, and none of a stream the saved model already knows.
+        scan_ids = st.session_state["message_ids"][:2000]
+        table = MessageTable(capacity=len(scan_ids))
+        st.session_state["messages"] = table
+        flush_cluster_models()
+        model = None if recluster else ClusterModel.load(CLUSTER_MODEL_PATH)
+        known_streams = model.streams if model is not None else {}
+        texts = []  # texts[i] / mids[i] belong to row i of the table
+        mids = table.ids
+        keys = []
+        embedded = []  # positions in texts that go through the encoder
+        stream_seen = {}
+
+        def scan_rows():
+            """Rows to embed, one list per metadata chunk, appended to the table as they arrive."""
+            for metas in prefetch(gmail.iter_messages_meta(scan_ids), SCAN_PREFETCH):
+                batch = []
+                for mid, meta in metas.items():
+                    if mid in table.row_of:
+                        continue
+                    # small texts for clustering: subject + snippet
+                    row = table.append(mid, meta)
+                    texts.append(table.text(row))
+                    key = stream_key(meta)
+                    if key:
+                        stream_seen[key] = stream_seen.get(key, 0) + 1
+                    if key not in known_streams and (not key or stream_seen[key] <= STREAM_SAMPLE):
+                        embedded.append(row)
+                        batch.append(row)
+                    keys.append(key)
+                yield batch
+
+        def show_progress():
+            done = len(texts)
+            progress.progress(min(1.0, done / max(1, len(scan_ids))), text=f"Fetched and embedded {done} of {len(scan_ids)} messages")
+
+        def scan_bodies():
+            """(row, subject + full body) for the rows to embed; bodies are fetched a chunk ahead.
+            A body that can't be fetched falls back to subject + snippet."""
+            for rows in scan_rows():
+                prefetcher.warm([table.ids[r] for r in rows])
+                for row in rows:
+                    body = prefetcher.try_get_text(table.ids[row])
+                    yield row, table.text(row) if body is None else f"Subject: {table.subjects[row]}\n{body}"
+                show_progress()
+
+        progress = st.progress(0.0, text="Fetching and embedding messages...")
+        emb = None
+        if full_bodies:
+            # chunked and pooled per message straight into a file-backed matrix; rows never embedded stay NaN
+            emb = body_matrix(len(scan_ids), clusterer.model.get_sentence_embedding_dimension())
+            clusterer.embed_bodies(scan_bodies(), emb)
+            emb = emb[:len(texts)]
+        else:
+            parts = []
+            for part in clusterer.embed_stream([texts[r] for r in rows] for rows in scan_rows()):
+                parts.append(part)
+                show_progress()
+            if parts:
+                # rows of messages that were never embedded stay NaN
+                emb = np.full((len(texts), parts[0].shape[1]), np.nan, dtype=np.float32)
+                emb[embedded] = np.concatenate(parts)
+        progress.empty()
+        st.info(f"Loaded metadata for {len(table)} messages. Now clustering...")
+
+        # cluster: reuse the saved model so only new mail is touched and cluster ids stay stable
+        if model is None:
+            clusters, streams = clusterer.cluster_streams(texts, keys, emb=emb)
+            model = clusterer.fit_model(texts, mids, clusters, emb=emb, streams=streams)
+        else:
+            known = model.member_ids()
+            new_idx = [i for i, mid in enumerate(mids) if mid not in known]
+            clusterer.assign_new(model, [texts[i] for i in new_idx], [mids[i] for i in new_idx],
+                                 emb=emb[new_idx] if emb is not None and new_idx else None,
+                                 keys=[keys[i] for i in new_idx])
+            clusters = model.mapping(mids)
+        if texts:  # an empty scan must not replace the saved model with an empty one
+            save_cluster_model(model)
+        st.session_state["cluster_model"] = model
+        st.session_state["cluster_labels"] = dict(model.labels)
+        table.set_clusters(clusters)
+        # local filter index: metadata now, plus any bodies already in the text cache
+        search_index = SearchIndex(table)
+        search_index.sync()
+        search_index.add_bodies(prefetcher.cache.peek_many(table.ids))
+        st.session_state["search_index"] = search_index
         st.success(f"Formed {len(clusters)} clusters.")
+
+
+def cluster_preview(table, cid, indices):
+    """Preview rows of one cluster, built once per table version and kept in the session."""
+    cache = st.session_state.setdefault("cluster_previews", {})
+    hit = cache.get(cid)
+    if hit is not None and hit[0] == table.version and np.array_equal(hit[1], indices[:PREVIEW_ROWS]):
+        return hit[2]
+    rows = [{
+        "message_id": table.ids[i],
+        "from": table.senders[i][:80],
+        "subject": table.subjects[i][:120],
+        "snippet": table.snippets[i][:180],
+    } for i in indices[:PREVIEW_ROWS]]
+    cache[cid] = (table.version, np.asarray(indices[:PREVIEW_ROWS]), rows)
+    return rows
+
+
+def render_cluster(table, cid, indices, meta):
+    """Body of one open cluster card."""
+    mids = table.ids
+    st.write(meta['summary'])
+    cols = st.columns([3, 1, 1])
+    if cols[2].button("Delete entire group", key=f"del_group_{cid}"):
+        ids_to_delete = [mids[i] for i in indices]
+        with st.spinner("Permanently deleting messages..."):
+            trashed, failed = gmail.bulk_trash(ids_to_delete)
+        if failed:
+            st.warning(f"Could not trash {len(failed)} messages.")
+        if trashed:
+            st.success(f"Successfully trashed {len(trashed)} messages.")
+            remove_mids_from_clusters(trashed)
+            st.session_state.pop(f"multiselect_{cid}", None)
+            st.rerun()
+    if cols[1].button("Archive entire group", key=f"archive_group_{cid}"):
+        ids_to_archive = [mids[i] for i in indices]
+        with st.spinner("Archiving messages..."):
+            archived, failed = gmail.bulk_archive(ids_to_archive)
+        if failed:
+            st.warning(f"Could not archive {len(failed)} messages.")
+        if archived:
+            st.success(f"Successfully archived {len(archived)} messages.")
+            remove_mids_from_clusters(archived)
+            st.session_state.pop(f"multiselect_{cid}", None)
+            st.rerun()
+
+    if cols[0].button("Score entire group", key=f"score_group_{cid}"):
+        group_ids = [mids[i] for i in indices]
+        with st.spinner("Scoring messages..."):
+            st.session_state[f"scores_{cid}"] = score_messages(gmail.get_messages_meta(group_ids))
+    scores = st.session_state.get(f"scores_{cid}")
+    if scores:
+        n_local = sum(1 for s in scores.values() if s["source"] == "local")
+        st.caption(f"{n_local} of {len(scores)} settled locally without calling Claude.")
+        st.dataframe(pd.DataFrame([
+            {
+                "subject": table.meta(mid).get("subject", "")[:120],
+                "score": s["score"],
+                "reason": s["reason"],
+                "source": s["source"],
+            }
+            for mid, s in scores.items()
+        ]))
+
+    # sample preview; bodies of the top rows are fetched in the background
+    prefetcher.warm([mids[i] for i in indices[:PREFETCH_ROWS]])
+    rows = cluster_preview(table, cid, indices)
+    subjects = {row["message_id"]: row["subject"] for row in rows}
+    st.dataframe(pd.DataFrame(rows), hide_index=True)
+    sel = st.multiselect("Select emails to preview/delete", options=list(subjects), format_func=subjects.get, key=f"multiselect_{cid}")
+    if sel:
+        # show full bodies in a modal-like area
+        for mid in sel:
+            text = prefetcher.get_text(mid)
+            st.session_state["search_index"].add_body(mid, text)
+            st.markdown(f"**From:** {table.meta(mid).get('from', '')}  ")
+            st.markdown(f"**Subject:** {table.meta(mid).get('subject', '')}  ")
+            st.text_area("Full email", value=text[:10000], height=300, key=f"email_{cid}_{mid}")
+            # safe-delete prediction for the single message
+            if st.button(f"Check safe-delete for this email ({mid[:8]})", key=f"score_{cid}_{mid}"):
+                with st.spinner("Asking Claude..."):
+                    out = safe_delete_score_for_message(text)
+                    # Parse the string response into a dict
+                    import json, re
+                    m = re.search(r'\{.*\}', out, re.S)
+                    if m:
+                        try:
+                            parsed_out = json.loads(m.group(0))
+                        except json.JSONDecodeError:
+                            try:
+                                parsed_out = ast.literal_eval(m.group(0))
+                            except (ValueError, SyntaxError):
+                                parsed_out = {"score": "Error", "reason": f"Could not parse response: {out}"}
+                    else:
+                        parsed_out = {"score": "Error", "reason": f"No dict found in response: {out}"}
+                    st.write(parsed_out["score"])
+                    st.caption(parsed_out["reason"])
+
+        if st.button("Delete selected emails (permanently)", key=f"delete_selected_{cid}"):
+            ids_to_delete = sel
+            with st.spinner("Moving messages to trash..."):
+                success_count, failure_count = gmail.move_to_trash(ids_to_delete)
+            if success_count > 0:
+                st.success(f"Successfully moved {success_count} messages to Trash.")
+                remove_mids_from_clusters(ids_to_delete)
+                st.session_state.pop(f"multiselect_{cid}", None)
+                st.rerun()
+
+
 with col2:
-    clusters_state = st.session_state.get("clusters", {})
+    table = st.session_state["messages"]
+    mapping = table.clusters()
 
     # ---- GUARD ----
-    if not clusters_state or not clusters_state.get("mapping"):
+    if not mapping:
         st.info("No emails left to display.")
         st.stop()
     # ----------------
 
     st.header("Clusters")
 
-    mapping = clusters_state["mapping"]
-    texts = clusters_state["texts"]
-    mids = clusters_state["mids"]
-
-    cluster_summaries = {}
-    for cid, indices in sorted(mapping.items(), key=lambda x: -len(x[1])):
-            label = st.session_state["cluster_labels"].get(str(cid))
-            if not label:
-                sample_texts = [texts[i] for i in indices[:6]]
-                # call claude to label/summarize
-                with st.spinner(f"Labeling cluster {cid}..."):
-                    try:
-                        out = summarize_cluster(sample_texts)
-                    except Exception as e:
-                        out = f'{{"label":"Cluster {cid}","summary":"Could not call Claude: {e}"}}'
-                # Claude returns text; try to parse minimal JSON heuristically
-                import json, re
-                m = re.search(r'\{.*\}', out, re.S)
-                if m:
-                    try:
-                        j = json.loads(m.group(0))
-                        label = j.get("label", f"Cluster {cid}")
-                        summ = j.get("summary", "")
-                    except Exception:
-                        label = f"Cluster {cid}"
-                        summ = out
-                else:
-                    label = f"Cluster {cid}"
-                    summ = out
-                st.session_state["cluster_labels"][str(cid)] = {"label": label, "summary": summ}
-            cluster_summaries[cid] = st.session_state["cluster_labels"][str(cid)]
-
-        # Display cluster cards
-    for cid, indices in sorted(mapping.items(), key=lambda x: -len(x[1])):
-            meta = cluster_summaries[cid]
-            with st.expander(f"{meta['label']} — {len(indices)} emails"):
-                #Index safety check
-                indices = [i for i in indices if i < len(mids)]
-                if not indices:
-                    continue
-                st.write(meta['summary'])
-                cols = st.columns([3, 1, 1])
-                if cols[2].button("Delete entire group", key=f"del_group_{cid}"):
-                    ids_to_delete = [mids[i] for i in indices]
-                    with st.spinner("Permanently deleting messages..."):
-                        success_count, failure_count = gmail.move_to_trash(ids_to_delete)
-                    if success_count > 0:
-                        st.success(f"Successfully trashed {success_count} messages.")
-                        for mid in ids_to_delete:
-                            st.session_state["msgs_meta"].pop(mid, None)
-                        remove_mids_from_clusters(ids_to_delete)
-                        st.rerun()
-                        st.session_state.pop(f"multiselect_{cid}", None)
-                if cols[1].button("Archive entire group", key=f"archive_group_{cid}"):
-                    ids_to_archive = [mids[i] for i in indices]
-                    with st.spinner("Archiving messages..."):
-                        success_count, failure_count = gmail.archive_messages(ids_to_archive)
-                    if success_count > 0:
-                        st.success(f"Successfully archived {success_count} messages.")
-                        # Remove archived messages from session state
-                        for mid in ids_to_archive:
-                            st.session_state["msgs_meta"].pop(mid, None)
-                        remove_mids_from_clusters(ids_to_archive)
-                        st.rerun()
-                        st.session_state.pop(f"multiselect_{cid}", None)
-
-                # sample preview
-                sample_idx = indices[:10]
-                rows = []
-                for i in sample_idx:
-                    mid = mids[i]
-                    mmeta = st.session_state["msgs_meta"].get(mid, {})
-                    rows.append({
-                        "message_id": mid,
-                        "from": mmeta.get("from", "")[:80],
-                        "subject": mmeta.get("subject", "")[:120],
-                        "snippet": mmeta.get("snippet", "")[:180]
-                    })
-                df = pd.DataFrame(rows)
-                sel = st.multiselect("Select emails to preview/delete (select rows below)", options=list(df['message_id']), format_func=lambda x: df[df['message_id']==x]['subject'].values[0], key=f"multiselect_{cid}")
-                if sel:
-                    # show full bodies in a modal-like area
-                    for mid in sel:
-                        raw = gmail.get_message_raw(mid)
-                        raw_raw = raw.get("raw", "")
-                        text = extract_plaintext_from_raw(raw_raw) if raw_raw else "(no raw body cached)"
-                        st.markdown(f"**From:** {st.session_state['msgs_meta'][mid]['from']}  ")
-                        st.markdown(f"**Subject:** {st.session_state['msgs_meta'][mid]['subject']}  ")
-                        st.text_area("Full email", value=text[:10000], height=300, key=f"email_{cid}_{mid}")
-                        # safe-delete prediction for the single message
-                        if st.button(f"Check safe-delete for this email ({mid[:8]})", key=f"score_{cid}_{mid}"):
-                            with st.spinner("Asking Claude..."):
-                                out = safe_delete_score_for_message(text)
-                                # Parse the string response into a dict
-                                import json, re
-                                m = re.search(r'\{.*\}', out, re.S)
-                                if m:
-                                    try:
-                                        parsed_out = json.loads(m.group(0))
-                                    except json.JSONDecodeError:
-                                        try:
-                                            parsed_out = ast.literal_eval(m.group(0))
-                                        except (ValueError, SyntaxError):
-                                            parsed_out = {"score": "Error", "reason": f"Could not parse response: {out}"}
-                                else:
-                                    parsed_out = {"score": "Error", "reason": f"No dict found in response: {out}"}
-                                st.write(parsed_out["score"])
-                                st.caption(parsed_out["reason"])
-
-                    if st.button("Delete selected emails (permanently)", key=f"delete_selected_{cid}"):
-                        ids_to_delete = sel
-                        with st.spinner("Moving messages to trash..."):
-                            success_count, failure_count = gmail.move_to_trash(ids_to_delete)
-                        if success_count > 0:
-                            st.success(f"Successfully moved {success_count} messages to Trash.")
-                            for mid in ids_to_delete:
-                                st.session_state["msgs_meta"].pop(mid, None)
-                            remove_mids_from_clusters(ids_to_delete)
-                            st.rerun()
-                            st.session_state.pop(f"multiselect_{cid}", None)
-    else:
-        st.info("Scan your mailbox to see clusters.")
+    # Filter what was already fetched, from the local index; no Gmail query, no rescan.
+    # With a filter, clusters show (and their group actions apply to) matching messages only.
+    search_index = st.session_state["search_index"]
+    query = st.text_input("Filter fetched messages", key="filter_query",
+                          help="Words (all must match, word* for a prefix) and from:domain, cluster:id, after:YYYY-MM-DD, before:YYYY-MM-DD")
+    shown = mapping
+    if query.strip():
+        matches = search_index.search(query)
+        shown = table.group_rows(matches)
+        st.caption(f"{len(matches)} matching messages in {len(shown)} clusters")
+        with st.expander("Facets", expanded=False):
+            for name, counts in search_index.facets(matches).items():
+                st.caption(f"{name}: " + ", ".join(f"{value} ({n})" for value, n in counts))
+        if not shown:
+            st.stop()
+
+    # Only the current page is rendered: its clusters get a header row each, and the
+    # buttons, tables and previews of a cluster are built only while it is open.
+    order = table.cluster_order(shown)
+    n_pages = max(1, -(-len(order) // CLUSTERS_PER_PAGE))
+    page = st.number_input(f"Page (of {n_pages}, {len(order)} clusters)", min_value=1, max_value=n_pages, value=1, key="cluster_page")
+    page_cids = order[(page - 1) * CLUSTERS_PER_PAGE:page * CLUSTERS_PER_PAGE]
+
+    # label the unlabeled clusters of this page in one concurrent pass,
+    # each from a few representative members rather than the first ones
+    unlabeled = {}
+    for cid in page_cids:
+        if str(cid) not in st.session_state["cluster_labels"]:
+            candidates = [table.text(i) for i in evenly_spaced(mapping[cid], LABEL_CANDIDATES)]
+            unlabeled[cid] = [candidates[i] for i in clusterer.representatives(candidates)]
+    if unlabeled:
+        with st.spinner(f"Labeling {len(unlabeled)} clusters..."):
+            new_labels = label_clusters(unlabeled, cache=get_label_cache())
+        # fallbacks are shown for this session but not saved, so the next scan asks again
+        for cid, lab in new_labels.items():
+            st.session_state["cluster_labels"][str(cid)] = lab
+        saved = {str(cid): lab for cid, lab in new_labels.items() if not lab.get("failed")}
+        model = st.session_state.get("cluster_model")
+        if model is not None and saved:
+            model.labels.update(saved)
+            save_cluster_model(model)
+
+    # Display cluster cards
+    for cid in page_cids:
+        indices = shown[cid]
+        meta = st.session_state["cluster_labels"].get(str(cid), {"label": f"Cluster {cid}", "summary": ""})
+        count = f"{len(indices)} of {len(mapping[cid])}" if shown is not mapping else f"{len(indices)}"
+        with st.container(border=True):
+            if st.toggle(f"{meta['label']} — {count} emails", key=f"open_{cid}"):
+                render_cluster(table, cid, indices, meta)
@@ -0,0 +1,45 @@
+# streams.py
+import re
+from email.utils import parseaddr
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from prefilter import header_map
+
+# A mailing stream with at least this many messages becomes a cluster of its own.
+STREAM_MIN_SIZE = 10
+# Messages of a stream that are embedded to place its centroid; the rest are never embedded.
+STREAM_SAMPLE = STREAM_MIN_SIZE
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+_LIST_ID = re.compile(r"<([^>]+)>")
+
+
+def stream_key(meta: Dict[str, Any]) -> Optional[str]:
+    """
+    Identify the mailing stream a message belongs to from its headers:
+    "list:<List-Id>" for list mail, "sender:<address>" for other bulk mail
+    (List-Unsubscribe or Precedence: bulk/list/junk), None for everything else.
+    """
+    headers = header_map(meta)
+    list_id = headers.get("list-id", "").strip()
+    if list_id:
+        m = _LIST_ID.search(list_id)
+        return "list:" + (m.group(1) if m else list_id).strip().lower()
+    if "list-unsubscribe" in headers or headers.get("precedence", "").strip().lower() in BULK_PRECEDENCE:
+        address = parseaddr(headers.get("from", ""))[1].lower()
+        if address:
+            return "sender:" + address
+    return None
+
+
+def split_streams(keys: Sequence[Optional[str]], min_size: int = STREAM_MIN_SIZE) -> Tuple[Dict[str, List[int]], List[int]]:
+    """
+    Index messages by stream key. Returns ({key: indices} for streams of at
+    least min_size messages, indices of every other message).
+    """
+    index: Dict[str, List[int]] = {}
+    for i, key in enumerate(keys):
+        if key:
+            index.setdefault(key, []).append(i)
+    streams = {key: idx for key, idx in index.items() if len(idx) >= min_size}
+    rest = [i for i, key in enumerate(keys) if key not in streams]
+    return streams, rest
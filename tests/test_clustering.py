@@ -0,0 +1,81 @@
+# tests/test_clustering.py
+import numpy as np
+
+from benchmarks.fakes import FakeGmailService, FaultConfig, HashEncoder
+from benchmarks.synthetic import make_mailbox
+from clustering import ClusterModel, Clusterer, body_matrix
+from gmail_client import GmailClient
+from pipeline import Checkpoint, cluster_stage, list_stage, stream
+from utils import RateLimiter
+
+
+def clusterer() -> Clusterer:
+    return Clusterer(model=HashEncoder(dim=32), cache_dir=None)
+
+
+def test_empty_mailbox_model(tmp_path):
+    c = clusterer()
+    clusters, streams = c.cluster_streams([], [])
+    model = c.fit_model([], [], clusters, streams=streams)
+    assert model.cluster_ids == [] and model.centroids.shape[0] == 0
+
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    model = ClusterModel.load(path)
+    c.assign_new(model, ["Subject: hello\nworld"], ["m1"])
+    assert model.member_ids() == {"m1"}
+    assert model.centroids.shape == (1, 32)
+
+
+def test_pipeline_on_empty_mailbox(tmp_path):
+    service = FakeGmailService(make_mailbox(0), FaultConfig(latency=0, per_item_latency=0))
+    gmail = GmailClient(service=service, limiter=RateLimiter(1e9))
+    ckpt = Checkpoint(str(tmp_path / "ckpt.db"))
+    list_stage(gmail, ckpt, "", 100)
+    model = cluster_stage(clusterer(), ckpt, stream(gmail, clusterer(), ckpt, None), None, str(tmp_path / "model.npz"))
+    assert model is None
+
+
+def test_pipeline_with_every_batch_empty(tmp_path):
+    c = clusterer()
+    batches = [([], [], [], None)]
+    model = cluster_stage(c, Checkpoint(str(tmp_path / "ckpt.db")), batches, None, str(tmp_path / "model.npz"))
+    assert model is not None and model.cluster_ids == []
+    assert np.asarray(model.centroids).shape[0] == 0
+
+
+def test_discard_keeps_index_in_step_with_members():
+    model = ClusterModel(np.eye(2, 4), [0, 1], {0: ["a", "b", "c"], 1: ["d", "e"]})
+    model.discard(["b", "e", "unknown"])
+    assert model.members == {0: ["a", "c"], 1: ["d"]}
+    model.add_members(1, np.ones((1, 4)), ["f"])
+    cid = model.add_cluster(np.ones((2, 4)), ["g", "h"])
+    model.add_stream_members(cid, ["i"])
+    model.discard(["f", "g", "i", "a"])
+    assert model.members == {0: ["c"], 1: ["d"], cid: ["h"]}
+
+
+def test_embed_bodies_pools_chunks_and_skips_the_cache(tmp_path):
+    encoder = HashEncoder(dim=32)
+    encoder.max_seq_length = 8
+    c = Clusterer(model=encoder, cache_dir=str(tmp_path))
+    long_text = " ".join(f"word{i % 13}" for i in range(100))
+    first, second = body_matrix(3, 32), body_matrix(3, 32)
+    c.embed_bodies([(0, long_text), (2, "short body")], first, batch_size=4)
+    second[:] = 0  # another scan's matrix is a separate file
+
+    expected = encoder.encode(c.chunk_text(long_text)).mean(axis=0)
+    assert np.allclose(first[0], expected, atol=1e-5)
+    assert np.isnan(first[1]).all() and not np.isnan(first[2]).any()
+    assert len(c.cache) == 0
+
+
+def test_assign_new_reports_stream_and_nearest_members_of_one_cluster():
+    c = clusterer()
+    text = "Subject: weekly digest\nyour weekly digest of news"
+    centroid = c.embed_texts([text])
+    model = ClusterModel(centroid / np.linalg.norm(centroid), [0], {0: ["old"]}, streams={"list:digest": 0})
+    changed = c.assign_new(model, [text, text], ["by_stream", "by_centroid"], distance_threshold=0.5,
+                           keys=["list:digest", None])
+    assert sorted(changed[0]) == ["by_centroid", "by_stream"]
+    assert model.members[0] == ["old", "by_stream", "by_centroid"]
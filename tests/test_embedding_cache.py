@@ -0,0 +1,61 @@
+# tests/test_embedding_cache.py
+import builtins
+
+import numpy as np
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache
+
+
+def vec(value: float) -> np.ndarray:
+    return np.full((1, 4), value, dtype=np.float32)
+
+
+def test_crash_between_vector_and_key_append(tmp_path, monkeypatch):
+    cache = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    cache.put_many(["a"], vec(1))
+
+    real_open = builtins.open
+
+    def failing_open(path, mode="r", *args, **kwargs):
+        if path == cache.key_path and "a" in mode:
+            raise OSError("disk full")
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(embedding_cache, "open", failing_open, raising=False)
+    with pytest.raises(OSError):
+        cache.put_many(["lost"], vec(7))
+    monkeypatch.undo()
+
+    # the same process carries on, and so does a restarted one
+    cache.put_many(["b"], vec(2))
+    for c in (cache, EmbeddingCache("m", 4, cache_dir=str(tmp_path))):
+        c._mem.clear()
+        a, b, lost = c.get_many(["a", "b", "lost"])
+        assert a.tolist() == [1, 1, 1, 1]
+        assert b.tolist() == [2, 2, 2, 2]
+        assert lost is None
+
+
+def test_two_instances_share_the_files(tmp_path):
+    first = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    second = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    first.put_many(["a"], vec(1))
+    second.put_many(["b"], vec(2))
+    first.put_many(["c"], vec(3))
+    first._mem.clear()
+    assert [v.tolist()[0] for v in first.get_many(["a", "c"])] == [1, 3]
+    reloaded = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    assert [v.tolist()[0] for v in reloaded.get_many(["a", "b", "c"])] == [1, 2, 3]
+
+
+def test_partial_vector_is_cut_off_on_load(tmp_path):
+    cache = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    cache.put_many(["a"], vec(1))
+    with open(cache.vec_path, "ab") as f:
+        f.write(b"\0" * 6)  # crash halfway through a vector
+    reloaded = EmbeddingCache("m", 4, cache_dir=str(tmp_path))
+    reloaded.put_many(["b"], vec(2))
+    reloaded._mem.clear()
+    assert [v.tolist()[0] for v in reloaded.get_many(["a", "b"])] == [1, 2]
@@ -0,0 +1,53 @@
+# tests/test_gmail_client.py
+from benchmarks.fakes import FakeGmailService, FaultConfig
+from benchmarks.synthetic import make_mailbox
+from gmail_client import LIST_EPOCH, GmailClient
+from utils import RateLimiter
+
+FUTURE = 4102444800  # 2100-01-01
+
+
+def test_partitioned_listing_covers_mail_outside_the_date_window():
+    messages = make_mailbox(8000)
+    # newest first stays true: 50 messages from the future, 50 from before LIST_EPOCH
+    for i, msg in enumerate(messages[:50]):
+        msg["internalDate"] = str((FUTURE + (50 - i) * 3600) * 1000)
+    for i, msg in enumerate(messages[-50:]):
+        msg["internalDate"] = str((LIST_EPOCH - 86400 - i * 3600) * 1000)
+    service = FakeGmailService(messages, FaultConfig(latency=0, per_item_latency=0))
+    gmail = GmailClient(service=service, limiter=RateLimiter(1e9))
+
+    ids, exhausted = gmail._list_ids("", 100000)
+    assert exhausted
+    assert ids == [m["id"] for m in messages]
+
+
+def test_failed_history_sync_keeps_the_history_id(tmp_path, monkeypatch):
+    import utils
+    from benchmarks import fakes
+    from benchmarks.fakes import FakeRequest, _http_error
+    from mailbox_store import MailboxStore
+
+    monkeypatch.setattr(utils, "backoff_delay", lambda attempt: 0)
+    messages = make_mailbox(50)
+    service = FakeGmailService(messages, FaultConfig(latency=0, per_item_latency=0))
+    store = MailboxStore(str(tmp_path / "mailbox.db"))
+    gmail = GmailClient(store=store, service=service, limiter=RateLimiter(1e9))
+    ids = gmail.list_message_ids("", 1000)
+    start = store.get_history_id()
+
+    service.delete(ids[0])
+    service.relabel(ids[1], ["TRASH"], ["INBOX"])
+
+    def failing(self, **_):
+        def run():
+            raise _http_error(503, "backendError")
+        return FakeRequest(self.s, "history.list", run)
+
+    with monkeypatch.context() as m:
+        m.setattr(fakes._History, "list", failing)
+        assert gmail.list_message_ids("", 1000) == ids  # stale, but nothing was forgotten
+        assert store.get_history_id() == start
+
+    # the next scan replays the missed window
+    assert gmail.list_message_ids("", 1000) == ids[2:]
@@ -0,0 +1,38 @@
+# tests/test_labels.py
+import numpy as np
+
+import claude_client
+from benchmarks.fakes import FakeClaudeClient, FakeGmailService, FaultConfig, HashEncoder
+from benchmarks.synthetic import make_mailbox
+from clustering import ClusterModel, Clusterer
+from gmail_client import GmailClient
+from pipeline import label_stage
+from utils import RateLimiter
+
+
+def test_failed_labels_are_retried_on_the_next_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # LabelCache writes cluster_labels.json here
+    monkeypatch.delenv("ANTHROPIC_API_KEY", raising=False)
+    monkeypatch.setattr(claude_client, "client", None)
+    monkeypatch.setattr(claude_client, "limiter", RateLimiter(1e9, name="claude"))
+
+    messages = make_mailbox(30)
+    gmail = GmailClient(service=FakeGmailService(messages, FaultConfig(latency=0, per_item_latency=0)),
+                        limiter=RateLimiter(1e9))
+    clusterer = Clusterer(model=HashEncoder(dim=32), cache_dir=None)
+    ids = [m["id"] for m in messages]
+    path = str(tmp_path / "model.npz")
+    ClusterModel(np.eye(3, 32), [0, 1, 2], {0: ids[:10], 1: ids[10:20], 2: ids[20:]}).save(path)
+
+    # no API key: every request fails and nothing is persisted
+    model = ClusterModel.load(path)
+    label_stage(gmail, clusterer, model, path, None)
+    assert ClusterModel.load(path).labels == {}
+
+    # the next run reaches Claude and labels all of them
+    monkeypatch.setattr(claude_client, "client", FakeClaudeClient(latency=0))
+    model = ClusterModel.load(path)
+    label_stage(gmail, clusterer, model, path, None)
+    labels = ClusterModel.load(path).labels
+    assert sorted(labels) == ["0", "1", "2"]
+    assert all(lab["label"] == "Synthetic group" for lab in labels.values())
@@ -0,0 +1,63 @@
+# tests/test_parity.py
+"""The int8 ONNX backend must embed like the full-precision torch model.
+Skipped unless sentence-transformers, optimum/onnxruntime and both model files
+are already installed locally; nothing is downloaded."""
+import numpy as np
+import pytest
+from sklearn.metrics import adjusted_rand_score
+from sklearn.preprocessing import normalize
+
+from benchmarks.synthetic import make_mailbox, meta_texts
+from clustering import MODEL_NAME, Clusterer, onnx_int8_file
+
+N_MESSAGES = 300
+MIN_COSINE = 0.98
+MIN_NEIGHBOUR_AGREEMENT = 0.9
+MIN_ARI = 0.8
+
+
+def _cached(filename: str) -> bool:
+    from huggingface_hub import try_to_load_from_cache
+    path = try_to_load_from_cache(f"sentence-transformers/{MODEL_NAME}", filename)
+    return isinstance(path, str)
+
+
+@pytest.fixture(scope="module")
+def embeddings():
+    pytest.importorskip("sentence_transformers")
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("optimum")
+    if not (_cached("model.safetensors") or _cached("pytorch_model.bin")) or not _cached(onnx_int8_file()):
+        pytest.skip(f"{MODEL_NAME} torch and ONNX files are not in the local Hugging Face cache")
+    texts = meta_texts(make_mailbox(N_MESSAGES))
+    torch = Clusterer(cache_dir=None, backend="torch")
+    onnx = Clusterer(cache_dir=None, backend="onnx")
+    return torch, texts, torch.embed_texts(texts), onnx.embed_texts(texts)
+
+
+def test_vectors_match(embeddings):
+    _, _, ref, quant = embeddings
+    cos = (normalize(ref) * normalize(quant)).sum(axis=1)
+    assert cos.mean() >= MIN_COSINE
+
+
+def test_nearest_neighbours_match(embeddings):
+    _, _, ref, quant = embeddings
+    sims = []
+    for emb in (ref, quant):
+        emb = normalize(emb)
+        s = emb @ emb.T
+        np.fill_diagonal(s, -1)
+        sims.append(s.argmax(axis=1))
+    assert (sims[0] == sims[1]).mean() >= MIN_NEIGHBOUR_AGREEMENT
+
+
+def test_clusters_match(embeddings):
+    clusterer, texts, ref, quant = embeddings
+    labels = []
+    for emb in (ref, quant):
+        out = np.empty(len(texts), dtype=np.int64)
+        for cid, idx in clusterer.hybrid_clusters(texts, emb=emb).items():
+            out[idx] = cid
+        labels.append(out)
+    assert adjusted_rand_score(*labels) >= MIN_ARI
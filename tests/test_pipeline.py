@@ -0,0 +1,70 @@
+# tests/test_pipeline.py
+from benchmarks.fakes import FakeGmailService, FaultConfig, HashEncoder
+from benchmarks.synthetic import make_mailbox
+from clustering import Clusterer
+from gmail_client import GmailClient
+from pipeline import cluster_text, embed_stage, text_stage
+from text_cache import Prefetcher, TextCache
+from utils import RateLimiter
+
+
+def test_body_that_cannot_be_fetched_falls_back_to_snippet(tmp_path):
+    messages = make_mailbox(20)
+    service = FakeGmailService(messages, FaultConfig(latency=0, per_item_latency=0))
+    gmail = GmailClient(service=service, limiter=RateLimiter(1e9))
+    ids = [m["id"] for m in messages]
+    metas = gmail.get_messages_meta(ids)
+    gone = ids[3]
+    service.delete(gone)  # deleted between listing and the body fetch: 404
+
+    prefetcher = Prefetcher(gmail, TextCache(str(tmp_path / "text.db")))
+    batches = list(text_stage([(ids, [metas[mid] for mid in ids])], prefetcher, body_chars=None))
+    _, texts, keys = batches[0]
+    assert len(texts) == len(ids)
+    assert texts[3] == cluster_text(metas[gone])
+
+    clusterer = Clusterer(model=HashEncoder(dim=32), cache_dir=None)
+    _, _, _, emb = next(embed_stage(clusterer, batches, {}, full_bodies=True))
+    assert emb.shape == (len(ids), 32)
+
+
+def _batches(n_batches: int, size: int = 10, fail_at: int = -1):
+    for b in range(n_batches):
+        if b == fail_at:
+            raise RuntimeError("interrupted")
+        ids = [f"m{b}_{i}" for i in range(size)]
+        yield ids, [f"Subject: topic {i % 3}\nbody {b} {i}" for i in range(size)], [None] * size, None
+
+
+def test_cluster_stage_saves_every_few_batches(tmp_path, monkeypatch):
+    import pipeline
+    from clustering import ClusterModel
+
+    saves = []
+    real_save = ClusterModel.save
+    monkeypatch.setattr(ClusterModel, "save", lambda self, path: saves.append(path) or real_save(self, path))
+    ckpt = pipeline.Checkpoint(str(tmp_path / "ckpt.db"))
+    all_ids = [mid for ids, *_ in _batches(25) for mid in ids]
+    ckpt.add_ids(all_ids)
+    clusterer = Clusterer(model=HashEncoder(dim=32), cache_dir=None)
+    model = pipeline.cluster_stage(clusterer, ckpt, _batches(25), None, str(tmp_path / "model.npz"), seed_size=20)
+
+    assert len(saves) <= 25 // pipeline.SAVE_EVERY + 2
+    assert ckpt.counts() == (len(all_ids), len(all_ids))
+    assert ClusterModel.load(str(tmp_path / "model.npz")).member_ids() == set(all_ids) == model.member_ids()
+
+
+def test_cluster_stage_saves_what_it_has_when_interrupted(tmp_path):
+    import pytest
+
+    import pipeline
+    from clustering import ClusterModel
+
+    ckpt = pipeline.Checkpoint(str(tmp_path / "ckpt.db"))
+    ckpt.add_ids([mid for ids, *_ in _batches(25) for mid in ids])
+    clusterer = Clusterer(model=HashEncoder(dim=32), cache_dir=None)
+    with pytest.raises(RuntimeError):
+        pipeline.cluster_stage(clusterer, ckpt, _batches(25, fail_at=7), None, str(tmp_path / "model.npz"), seed_size=20)
+    # every id checkpointed as done is in the saved model
+    assert ckpt.counts()[1] == 70
+    assert len(ClusterModel.load(str(tmp_path / "model.npz")).member_ids()) == 70
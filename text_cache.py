@@ -0,0 +1,158 @@
+# text_cache.py
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import metrics
+from processor import extract_plaintext_from_raw, DEFAULT_MAX_CHARS
+
+TEXT_CACHE_PATH = "text_cache.db"
+
+
+class TextCache:
+    """
+    Extracted plaintext keyed by message id.
+    Hot entries live in an in-memory LRU capped at max_memory_chars; every
+    entry is also written to SQLite, which is pruned to max_disk_items by last access.
+    """
+
+    def __init__(self, path: str = TEXT_CACHE_PATH, max_memory_chars: int = 20_000_000, max_disk_items: int = 100_000):
+        self.max_memory_chars = max_memory_chars
+        self.max_disk_items = max_disk_items
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, str]" = OrderedDict()
+        self._mem_chars = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS texts (id TEXT PRIMARY KEY, text TEXT, accessed REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS texts_by_access ON texts(accessed)")
+        self._conn.commit()
+        self._puts = 0
+
+    def get(self, message_id: str) -> Optional[str]:
+        with self._lock:
+            text = self._mem.get(message_id)
+            if text is not None:
+                self._mem.move_to_end(message_id)
+                return text
+            row = self._conn.execute("SELECT text FROM texts WHERE id=?", (message_id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE texts SET accessed=? WHERE id=?", (time.time(), message_id))
+            self._conn.commit()
+            self._remember(message_id, row[0])
+            return row[0]
+
+    def peek_many(self, message_ids: Iterable[str]) -> Dict[str, str]:
+        """Cached texts of the given ids, without touching the LRU or access times (for indexing)."""
+        out: Dict[str, str] = {}
+        ids = list(message_ids)
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT id, text FROM texts WHERE id IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                out.update(rows)
+        return out
+
+    def __contains__(self, message_id: str) -> bool:
+        with self._lock:
+            if message_id in self._mem:
+                return True
+            return self._conn.execute("SELECT 1 FROM texts WHERE id=?", (message_id,)).fetchone() is not None
+
+    def put(self, message_id: str, text: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO texts(id, text, accessed) VALUES (?, ?, ?)", (message_id, text, time.time()))
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._prune()
+            self._conn.commit()
+            self._remember(message_id, text)
+
+    def discard(self, message_ids: Iterable[str]):
+        with self._lock:
+            for mid in message_ids:
+                text = self._mem.pop(mid, None)
+                if text is not None:
+                    self._mem_chars -= len(text)
+                self._conn.execute("DELETE FROM texts WHERE id=?", (mid,))
+            self._conn.commit()
+
+    def _remember(self, message_id: str, text: str):
+        old = self._mem.pop(message_id, None)
+        if old is not None:
+            self._mem_chars -= len(old)
+        self._mem[message_id] = text
+        self._mem_chars += len(text)
+        while self._mem_chars > self.max_memory_chars and len(self._mem) > 1:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_chars -= len(evicted)
+
+    def _prune(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM texts").fetchone()[0]
+        if count > self.max_disk_items:
+            self._conn.execute(
+                "DELETE FROM texts WHERE id IN (SELECT id FROM texts ORDER BY accessed LIMIT ?)",
+                (count - self.max_disk_items,)
+            )
+
+
+class Prefetcher:
+    """Fetches and extracts message bodies into a TextCache, on demand or in the background."""
+
+    def __init__(self, gmail, cache: TextCache, max_workers: int = 4, max_chars: Optional[int] = DEFAULT_MAX_CHARS):
+        self.gmail = gmail
+        self.cache = cache
+        self.max_chars = max_chars
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        # RLock: a future that is already done runs its callback inside _submit
+        self._lock = threading.RLock()
+        self._inflight = {}
+
+    def _load(self, message_id: str) -> str:
+        raw = self.gmail.get_message_raw(message_id).get("raw", "")
+        text = extract_plaintext_from_raw(raw, self.max_chars) if raw else "(no raw body cached)"
+        self.cache.put(message_id, text)
+        return text
+
+    def _submit(self, message_id: str):
+        with self._lock:
+            fut = self._inflight.get(message_id)
+            if fut is None:
+                fut = self._pool.submit(self._load, message_id)
+                self._inflight[message_id] = fut
+                fut.add_done_callback(lambda _, mid=message_id: self._done(mid))
+            return fut
+
+    def _done(self, message_id: str):
+        with self._lock:
+            self._inflight.pop(message_id, None)
+
+    def get_text(self, message_id: str) -> str:
+        """Cached plaintext, or fetch it now (joining a prefetch already in flight)."""
+        text = self.cache.get(message_id)
+        if text is not None:
+            metrics.incr("text_cache.hits")
+            return text
+        metrics.incr("text_cache.misses")
+        return self._submit(message_id).result()
+
+    def try_get_text(self, message_id: str) -> Optional[str]:
+        """get_text, or None when the body can't be fetched (deleted since listing, timeout)."""
+        try:
+            return self.get_text(message_id)
+        except Exception as e:
+            metrics.incr("text_cache.fetch_errors")
+            print(f"Could not fetch body of {message_id}: {e}")
+            return None
+
+    def warm(self, message_ids: Iterable[str]):
+        """Queue background fetches for ids not cached yet; returns immediately."""
+        for mid in message_ids:
+            if mid not in self.cache:
+                self._submit(mid)
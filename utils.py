@@ -1,16 +1,216 @@
 # utils.py
+import asyncio
+import queue
+import random
+import threading
 import time
-from typing import Iterable, List
+from typing import Iterable, List, Optional, Sequence
+
+import metrics
 
 def chunks(iterable: Iterable, size: int):
     lst = list(iterable)
     for i in range(0, len(lst), size):
         yield lst[i:i+size]
 
-def rate_limited_executor(items: List, fn, batch_size: int = 100, delay_seconds: float = 0.5):
-    """Run fn on batch of items, sleeping between batches to avoid quota bursts."""
-    results = []
-    for batch in chunks(items, batch_size):
-        results.append(fn(batch))
-        time.sleep(delay_seconds)
-    return results
+def evenly_spaced(items: Sequence, n: int) -> List:
+    """At most n items spread evenly over the sequence (all of them when it is short)."""
+    if len(items) <= n:
+        return list(items)
+    step = len(items) / n
+    return [items[int(i * step)] for i in range(n)]
+
+def rate_limited_executor(items: List, fn, batch_size: int = 100, limiter: Optional["RateLimiter"] = None, cost: float = 1):
+    """Run fn on batches of items. Each batch takes `cost` units from limiter and is retried on throttling."""
+    limiter = limiter or RateLimiter(2.0)
+    return [call_with_retry(lambda b=batch: fn(b), limiter, cost) for batch in chunks(items, batch_size)]
+
+
+class _Raised:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+_END = object()
+
+
+def prefetch(iterable: Iterable, maxsize: int = 2):
+    """
+    Iterate `iterable` on a background thread, at most maxsize items ahead of the
+    consumer. Chaining generators through prefetch() makes a streaming pipeline
+    whose stages overlap while memory stays bounded. An exception in the producer
+    is re-raised in the consumer; abandoning the iterator stops the producer.
+    """
+    buf: "queue.Queue" = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Raised(e))
+            return
+        put(_END)
+
+    threading.Thread(target=produce, daemon=True, name="prefetch").start()
+    try:
+        while True:
+            item = buf.get()
+            if item is _END:
+                return
+            if isinstance(item, _Raised):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+
+# -----------------------------
+# RATE LIMITING
+# -----------------------------
+RETRYABLE_STATUS = {429, 500, 502, 503, 504, 529}  # 529: Anthropic "overloaded"
+THROTTLE_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket measured in quota units per second, with AIMD:
+    the rate is halved on every throttling response (on_throttle) and grows
+    back by a small step per successful call (on_success), never above the
+    configured ceiling. Callers take units with acquire(cost) or, from a
+    coroutine, await acquire_async(cost).
+
+    A call costing more than the bucket holds is still admitted; the bucket
+    goes into debt and later callers wait it off, so large requests (a whole
+    HTTP batch) are paced correctly instead of blocking forever.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, name: str = "ratelimit",
+                 min_rate: Optional[float] = None, increase: Optional[float] = None, decrease: float = 0.5):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.min_rate = min_rate if min_rate is not None else self.max_rate / 32
+        self.increase = increase if increase is not None else self.max_rate / 20
+        self.decrease = decrease
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, cost: float) -> float:
+        """Take cost units now and return how long the caller must wait for them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= cost
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            metrics.incr(f"{self.name}.wait_seconds", wait)
+        return wait
+
+    def acquire(self, cost: float = 1):
+        wait = self._reserve(cost)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, cost: float = 1):
+        wait = self._reserve(cost)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        metrics.incr(f"{self.name}.throttled")
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # stop the burst that provoked the throttle
+            self._tokens = min(self._tokens, 0.0)
+
+
+def error_status(exc: BaseException) -> Optional[int]:
+    """HTTP status of a googleapiclient HttpError (resp.status) or an anthropic APIStatusError (status_code)."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttle_error(exc: BaseException) -> bool:
+    """429 / 529 from either API, or Gmail's 403 rateLimitExceeded / userRateLimitExceeded."""
+    status = error_status(exc)
+    if status in (429, 529):
+        return True
+    if status == 403:
+        content = getattr(exc, "content", b"") or b""
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", "replace")
+        return any(reason in content for reason in THROTTLE_REASONS)
+    return False
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return is_throttle_error(exc) or error_status(exc) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 32.0) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call_with_retry(fn, limiter: RateLimiter, cost: float = 1, max_retries: int = 5):
+    """Call fn() after taking `cost` units from limiter. Throttling slows the limiter down;
+    throttling and transient errors are retried with jittered backoff, anything else is raised."""
+    for attempt in range(max_retries + 1):
+        limiter.acquire(cost)
+        try:
+            result = fn()
+        except Exception as e:
+            if is_throttle_error(e):
+                limiter.on_throttle()
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            metrics.incr(f"{limiter.name}.retries")
+            time.sleep(backoff_delay(attempt))
+            continue
+        limiter.on_success()
+        return result
+
+
+async def call_with_retry_async(fn, limiter: RateLimiter, cost: float = 1, max_retries: int = 5):
+    """call_with_retry for coroutines: fn() must return an awaitable."""
+    for attempt in range(max_retries + 1):
+        await limiter.acquire_async(cost)
+        try:
+            result = await fn()
+        except Exception as e:
+            if is_throttle_error(e):
+                limiter.on_throttle()
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            metrics.incr(f"{limiter.name}.retries")
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        limiter.on_success()
+        return result